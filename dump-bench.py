@@ -0,0 +1,341 @@
+#! /usr/bin/env python3
+
+# Benchmarks dynamodb-dump.py and kinesis-dump.py against a local stand-in
+# for AWS, so that changes to the scan loop, the decoding, or the output can
+# be measured without touching real tables and streams.
+#
+# The stand-in is any server that speaks the DynamoDB and Kinesis APIs, e.g.
+#   moto_server -p 5000                   (pip install 'moto[server]')
+#   java -jar DynamoDBLocal.jar           (DynamoDB only)
+# or, with --moto, a moto server started inside this script.
+#
+# The table and stream are filled with generated items and records, then
+# each dump mode is run as a separate process and timed.  Note that a
+# stand-in is much slower than AWS for some calls (moto scans the whole
+# table for every page), so compare modes against each other rather than
+# against production numbers:
+#   dump-bench.py --moto --items 20000 --item-size 400 --records 20000 --shards 4
+#   dump-bench.py --endpoint-url http://localhost:5000 --no-populate \
+#       --dynamodb-mode '' --dynamodb-mode '--segments 8'
+#
+# With --startup, only the time each dumper takes to start and print its
+# --help is measured, which needs no stand-in.  The dumpers are run in tight
+# shell loops, so --startup-budget makes the check fail if they get slower:
+#   dump-bench.py --startup --startup-budget 0.15
+
+default_profile = 'fbot-sandbox'
+
+import argparse
+import json
+import logging
+import os
+import pathlib
+import random
+import shlex
+import socket
+import string
+import subprocess
+import sys
+import statistics
+import time
+
+here = pathlib.Path(__file__).resolve().parent
+
+# The dumpers' rate limits are for sharing real tables and streams; against
+# a stand-in they would only measure the limits, so they're lifted.
+default_dynamodb_modes = [
+    '',
+    '--segments 4',
+    '--segments 16',
+    '-f parquet',
+]
+default_kinesis_modes = [
+    '-f ndjson',
+    '-f ndjson --all-shards',
+    '-f ndjson --all-shards --order arrival',
+    '-f json --all-shards',
+]
+unlimited = {
+    'dynamodb': ['--read-capacity', '1000000000'],
+    'kinesis': ['--capacity-fraction', '1000000'],
+}
+
+def random_text(size):
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=size))
+
+def populate_table(client, table, items, item_size):
+    try:
+        client.delete_table(TableName=table)
+        client.get_waiter('table_not_exists').wait(TableName=table)
+    except client.exceptions.ResourceNotFoundException:
+        pass
+    client.create_table(
+        TableName=table,
+        KeySchema=[
+            { 'AttributeName': 'id', 'KeyType': 'HASH' },
+            { 'AttributeName': 'n', 'KeyType': 'RANGE' },
+        ],
+        AttributeDefinitions=[
+            { 'AttributeName': 'id', 'AttributeType': 'S' },
+            { 'AttributeName': 'n', 'AttributeType': 'N' },
+        ],
+        BillingMode='PAY_PER_REQUEST')
+    client.get_waiter('table_exists').wait(TableName=table)
+
+    # A mix of the attribute types the dumper has to convert.
+    def item(i):
+        return {
+            'id': { 'S': f'tenant{i % 100}' },
+            'n': { 'N': str(i) },
+            'price': { 'N': f'{random.randrange(100000) / 100:.2f}' },
+            'active': { 'BOOL': i % 2 == 0 },
+            'tags': { 'SS': ['a', 'b', f't{i % 7}'] },
+            'address': { 'M': {
+                'city': { 'S': 'Los Angeles' },
+                'zip': { 'N': '90001' },
+                'lines': { 'L': [{ 'S': '1 Main St' }, { 'NULL': True }] },
+            } },
+            'payload': { 'S': random_text(max(0, item_size - 150)) },
+        }
+
+    # BatchWriteItem takes up to 25 items per call.
+    for start in range(0, items, 25):
+        requests = [{ 'PutRequest': { 'Item': item(i) } } for i in range(start, min(items, start + 25))]
+        while requests:
+            r = client.batch_write_item(RequestItems={ table: requests })
+            requests = r.get('UnprocessedItems', {}).get(table, [])
+
+def populate_stream(client, stream, records, record_size, shards):
+    try:
+        client.delete_stream(StreamName=stream)
+        client.get_waiter('stream_not_exists').wait(StreamName=stream)
+    except client.exceptions.ResourceNotFoundException:
+        pass
+    client.create_stream(StreamName=stream, ShardCount=shards)
+    client.get_waiter('stream_exists').wait(StreamName=stream)
+
+    def record(i):
+        data = { 'i': i, 'merchantId': f'm{i % 100}', 'payload': random_text(max(0, record_size - 60)) }
+        return { 'Data': json.dumps(data).encode('utf-8'), 'PartitionKey': f'pk{i}' }
+
+    # PutRecords takes up to 500 records per call.
+    for start in range(0, records, 500):
+        batch = [record(i) for i in range(start, min(records, start + 500))]
+        while batch:
+            r = client.put_records(StreamName=stream, Records=batch)
+            batch = [b for b, result in zip(batch, r['Records']) if 'ErrorCode' in result]
+
+# Runs a dumper, given as `python -c rss_wrapper FD script args...`, and
+# writes its peak RSS in kilobytes to FD as it exits.  The child's
+# ru_maxrss won't do: Linux carries the RSS the child had before exec,
+# i.e. this script's, over into it.  VmHWM starts afresh with exec.
+rss_wrapper = """
+import atexit, os, resource, runpy, sys
+fd = int(sys.argv.pop(1))
+def report():
+    try:
+        with open('/proc/self/status') as f:
+            kb = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+    except OSError:
+        # No /proc, e.g. on macOS, where ru_maxrss is in bytes.
+        kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+    os.write(fd, str(kb).encode())
+atexit.register(report)
+sys.argv.pop(0)
+runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+def run_dump(command):
+    """Runs a dump, returning its wall time, output size, number of output lines, resource usage and peak RSS in MB."""
+    rss_read, rss_write = os.pipe()
+    start = time.perf_counter()
+    p = subprocess.Popen([command[0], '-c', rss_wrapper, str(rss_write), *command[1:]],
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, pass_fds=(rss_write,))
+    os.close(rss_write)
+    size = 0
+    lines = 0
+    head = b''
+    while True:
+        chunk = p.stdout.read(1024 * 1024)
+        if not chunk:
+            break
+        if b'\n' not in head: head += chunk
+        size += len(chunk)
+        lines += chunk.count(b'\n')
+    _, status, rusage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.perf_counter() - start
+    with open(rss_read, 'rb') as f:
+        peak_rss = f.read()
+    if p.returncode != 0:
+        raise Exception(f'{shlex.join(command)} exited with {p.returncode}')
+    peak_rss = int(peak_rss) / 1e3
+    # Only NDJSON has one item per line.
+    try:
+        json.loads(head.split(b'\n', 1)[0])
+    except ValueError:
+        lines = None
+    return elapsed, size, lines, rusage, peak_rss
+
+def bench(tool, target, modes, count, **opts):
+    results = []
+    for mode in modes:
+        command = [sys.executable, str(here / f'{tool}-dump.py'), target,
+                   '-p', opts['profile'], '--endpoint-url', opts['endpoint_url'],
+                   *unlimited[tool], *shlex.split(mode)]
+        if tool == 'kinesis' and '--all-shards' not in mode and opts['shards'] > 1:
+            print(f'{tool} {mode!r}: reads only one of {opts["shards"]} shards', file=sys.stderr)
+        best = None
+        for _ in range(opts['repeat']):
+            result = run_dump(command)
+            if best is None or result[0] < best[0]:
+                best = result
+        elapsed, size, lines, rusage, peak_rss = best
+        items = lines if lines is not None else count
+        results.append({
+            'tool': tool,
+            'mode': mode,
+            'items': items,
+            'seconds': elapsed,
+            'items_per_second': items / elapsed,
+            'mb_per_second': size / elapsed / 1e6,
+            'output_mb': size / 1e6,
+            'cpu_seconds': rusage.ru_utime + rusage.ru_stime,
+            'peak_rss_mb': peak_rss,
+        })
+        print_result(results[-1])
+    return results
+
+def bench_startup(tool, count):
+    """Returns the median wall time of `tool-dump.py --help` over count runs."""
+    command = [sys.executable, str(here / f'{tool}-dump.py'), '--help']
+    times = []
+    for _ in range(count):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def print_header():
+    print(f'{"tool":<9} {"mode":<40} {"items":>8} {"secs":>7} {"items/s":>9} {"MB/s":>7} {"cpu s":>7} {"rss MB":>7}')
+
+def print_result(r):
+    print(f'{r["tool"]:<9} {r["mode"] or "(default)":<40} {r["items"]:>8} {r["seconds"]:>7.2f} '
+          f'{r["items_per_second"]:>9.0f} {r["mb_per_second"]:>7.2f} {r["cpu_seconds"]:>7.2f} {r["peak_rss_mb"]:>7.1f}')
+    sys.stdout.flush()
+
+def start_moto():
+    from moto.server import ThreadedMotoServer
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    return server, f'http://127.0.0.1:{port}'
+
+########################################################################
+
+parser = argparse.ArgumentParser(description='Benchmark the dump tools against a local stand-in for AWS.')
+endpoint_group = parser.add_mutually_exclusive_group()
+endpoint_group.add_argument(
+    '--endpoint-url', metavar='URL',
+    help='URL of a running moto server or DynamoDB Local')
+endpoint_group.add_argument(
+    '--moto', action='store_true',
+    help='start a moto server for the benchmark')
+parser.add_argument(
+    '-p', '--profile', default=default_profile,
+    help=f'AWS profile to use; only its region matters to a stand-in (default {default_profile})')
+parser.add_argument(
+    '--table', default='dump-bench',
+    help='table to fill and dump (default dump-bench)')
+parser.add_argument(
+    '--stream', default='dump-bench',
+    help='stream to fill and dump (default dump-bench)')
+parser.add_argument(
+    '--items', type=int, default=10000,
+    help='number of items to put in the table (default 10000; 0 skips the DynamoDB benchmark)')
+parser.add_argument(
+    '--item-size', type=int, default=400,
+    help='approximate size of each item in bytes (default 400)')
+parser.add_argument(
+    '--records', type=int, default=10000,
+    help='number of records to put on the stream (default 10000; 0 skips the Kinesis benchmark)')
+parser.add_argument(
+    '--record-size', type=int, default=400,
+    help='approximate size of each record in bytes (default 400)')
+parser.add_argument(
+    '--shards', type=int, default=4,
+    help='number of shards of the stream (default 4)')
+parser.add_argument(
+    '--no-populate', action='store_true',
+    help='dump the existing table and stream instead of refilling them')
+parser.add_argument(
+    '--dynamodb-mode', action='append', metavar='ARGS',
+    help='dynamodb-dump.py arguments to benchmark; may be repeated (default: several)')
+parser.add_argument(
+    '--kinesis-mode', action='append', metavar='ARGS',
+    help='kinesis-dump.py arguments to benchmark; may be repeated (default: several)')
+parser.add_argument(
+    '--repeat', type=int, default=1,
+    help='run each mode this many times and report the fastest run (default 1)')
+parser.add_argument(
+    '--json', metavar='FILE',
+    help='also write the results as JSON to FILE')
+parser.add_argument(
+    '--startup', action='store_true',
+    help='only measure how long each dumper takes to start, as the median of --repeat runs of --help')
+parser.add_argument(
+    '--startup-budget', type=float, metavar='SECONDS',
+    help='with --startup, exit with an error if a dumper takes longer than this to start')
+args = parser.parse_args()
+
+if args.startup:
+    results = []
+    for tool in ('dynamodb', 'kinesis'):
+        seconds = bench_startup(tool, max(args.repeat, 5))
+        results.append({ 'tool': tool, 'startup_seconds': seconds })
+        print(f'{tool:<9} {seconds * 1000:>7.1f} ms')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    slow = [r['tool'] for r in results if args.startup_budget and r['startup_seconds'] > args.startup_budget]
+    if slow:
+        sys.exit(f'{", ".join(slow)} took longer than {args.startup_budget * 1000:.0f} ms to start')
+    sys.exit()
+if not args.moto and not args.endpoint_url:
+    parser.error('one of the arguments --endpoint-url --moto is required')
+
+import botocore.session
+
+server = None
+if args.moto:
+    server, args.endpoint_url = start_moto()
+
+session = botocore.session.Session(profile=args.profile)
+opts = dict(profile=args.profile, endpoint_url=args.endpoint_url, shards=args.shards, repeat=args.repeat)
+results = []
+try:
+    if args.items:
+        if not args.no_populate:
+            print(f'filling table {args.table} with {args.items} items', file=sys.stderr)
+            populate_table(session.create_client('dynamodb', endpoint_url=args.endpoint_url),
+                           args.table, args.items, args.item_size)
+    if args.records:
+        if not args.no_populate:
+            print(f'filling stream {args.stream} with {args.records} records', file=sys.stderr)
+            populate_stream(session.create_client('kinesis', endpoint_url=args.endpoint_url),
+                            args.stream, args.records, args.record_size, args.shards)
+
+    print_header()
+    if args.items:
+        results += bench('dynamodb', args.table, args.dynamodb_mode or default_dynamodb_modes, args.items, **opts)
+    if args.records:
+        results += bench('kinesis', args.stream, args.kinesis_mode or default_kinesis_modes, args.records, **opts)
+finally:
+    if server: server.stop()
+
+if args.json:
+    with open(args.json, 'w') as f:
+        json.dump(results, f, indent=2)
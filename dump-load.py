@@ -0,0 +1,352 @@
+#! /usr/bin/env python3
+
+# Loads the ndjson written by dynamodb-dump.py and kinesis-dump.py into a
+# table or stream, e.g. to copy sandbox data around:
+#   dynamodb-dump.py merchants -o merchants.ndjson
+#   dump-load.py dynamodb merchants-copy merchants.ndjson
+#   kinesis-dump.py fbt-event --all-shards --since 1d --full-event -f ndjson --compress gzip -o day.ndjson.gz
+#   dump-load.py kinesis fbt-event-test day.ndjson.gz --full-event --base64
+#
+# Items are written with BatchWriteItem, 25 at a time, by several threads,
+# each of which takes the items of a share of the partitions.  Records are
+# put with PutRecords, up to 500 at a time, by a thread per shard of the
+# stream, each of which takes the records whose partition keys hash to its
+# shard.  Items and records that are throttled are retried, and the writes
+# are paced to the capacity of the table or the shards.
+
+default_profile = 'fbot-sandbox'
+debug = False
+
+import argparse
+import base64
+import bisect
+import hashlib
+import json
+import math
+import random
+import sys
+import threading
+import time
+
+# botocore and jmespath are imported when they're first used; see dumputil.
+# Run ./setup and activate venv3 to install them.
+import dumputil
+
+class bcolors:
+    WARNING     = '\033[93m'    # bright yellow
+    ENDC        = '\033[0m'
+    GREY20      = f'\033[38;5;{232 + 20}m'
+
+# https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.batch_write_item
+# https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/kinesis.html#Kinesis.Client.put_records
+
+# BatchWriteItem takes up to 25 items.  A write capacity unit is one write
+# per second of an item of up to 1 KB.  On-demand tables have no
+# provisioned write capacity; default to what a single partition can take.
+batch_write_items = 25
+on_demand_write_capacity = 1000 # WCU per second
+
+# PutRecords takes up to 500 records and 5 MB, and each shard takes up to
+# 1000 records and 1 MB per second.
+# https://docs.aws.amazon.com/streams/latest/dev/service-sizes-and-limits.html
+put_records_count = 500
+put_records_bytes = 5 * 1024 * 1024
+shard_write_records = 1000
+shard_write_bytes = 1024 * 1024
+
+def read_lines(paths, limit=None):
+    """Yields the non-empty lines of the files, or of stdin if there are none."""
+    n = 0
+    for path in paths or [None]:
+        with dumputil.open_source(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                if limit and n >= limit:
+                    return
+                yield line
+                n += 1
+
+def close_all(batchers):
+    """Waits for every batcher, then raises the first error if there was one."""
+    error = None
+    for b in batchers:
+        try:
+            b.close()
+        except BaseException as e:
+            error = error or e
+    if error:
+        raise error
+
+def print_loaded(n, target, start):
+    elapsed = time.monotonic() - start
+    print(f'loaded {n} records into {target} in {elapsed:.1f}s ({n / max(elapsed, 1e-9):.0f}/s)', file=sys.stderr)
+
+########################################################################
+# DynamoDB
+
+def write_limiter(description, **opts):
+    capacity = opts.get('write_capacity') or description['ProvisionedThroughput']['WriteCapacityUnits'] or on_demand_write_capacity
+    rate = capacity * (opts.get('capacity_fraction') or 1)
+    if debug: print(f'{bcolors.GREY20}writing at most {rate} WCU/s{bcolors.ENDC}', file=sys.stderr)
+    return dumputil.RateLimiter(rate)
+
+def write_items(client, table, items, limiter, stop):
+    """Writes a batch of (item, units) with BatchWriteItem, retrying unprocessed items.
+
+    Returns False if the stop event was set before every item was written.
+    """
+    requests = [{ 'PutRequest': { 'Item': item } } for item, _ in items]
+    # Reserve the capacity the items are expected to use, and settle the
+    # difference once the call reports what it actually consumed.
+    estimate = sum(units for _, units in items)
+    while requests:
+        if not limiter.acquire(estimate, stop):
+            return False
+        try:
+            r = client.batch_write_item(RequestItems={ table: requests }, ReturnConsumedCapacity='TOTAL')
+        except (client.exceptions.ProvisionedThroughputExceededException,
+                client.exceptions.RequestLimitExceeded) as e:
+            print(f'{bcolors.WARNING}caught {e}{bcolors.ENDC}', file=sys.stderr)
+            stop.wait(limiter.throttled())
+            continue
+        if 'ConsumedCapacity' in r:
+            limiter.consume(sum(c.get('CapacityUnits', 0) for c in r['ConsumedCapacity']) - estimate)
+        unprocessed = r.get('UnprocessedItems', {}).get(table, [])
+        if unprocessed:
+            # Items are left unprocessed when their partitions are
+            # throttled; back off before writing them again.
+            if debug: print(f'{bcolors.GREY20}{len(unprocessed)} of {len(requests)} items unprocessed{bcolors.ENDC}', file=sys.stderr)
+            estimate = math.ceil(estimate * len(unprocessed) / len(requests))
+            stop.wait(limiter.throttled())
+        else:
+            limiter.succeeded()
+        requests = unprocessed
+    return True
+
+def load_table(table, paths, profile, **opts):
+    client = dumputil.aws_client('dynamodb', profile, opts.get('endpoint_url'))
+
+    description = client.describe_table(TableName=table)['Table']
+    key_names = [k['AttributeName'] for k in description['KeySchema']]
+    partition_key = next(k['AttributeName'] for k in description['KeySchema'] if k['KeyType'] == 'HASH')
+    # The dump wrote binary values as base64 strings; those of the key
+    # attributes have to be binary again.
+    binary_keys = [a['AttributeName'] for a in description['AttributeDefinitions']
+                   if a['AttributeName'] in key_names and a['AttributeType'] == 'B']
+
+    # All workers share one limiter, so together they stay within the
+    # table's write capacity.
+    limiter = write_limiter(description, **opts)
+    stop = threading.Event()
+
+    # Each worker takes the items of a share of the partition keys, so that
+    # the writes to an item are made in the order they were dumped.  Writes
+    # to the same item within a batch replace each other, since
+    # BatchWriteItem rejects batches with duplicate keys.
+    workers = opts.get('workers') or 8
+    loaded = [0] * workers
+    def sender(i):
+        def send(items):
+            if write_items(client, table, items, limiter, stop):
+                loaded[i] += len(items)
+        return send
+    def item_key(entry):
+        return tuple(next(iter(entry[0][k].values())) for k in key_names)
+    batchers = [dumputil.Batcher(sender(i), batch_write_items, key=item_key) for i in range(workers)]
+
+    start = time.monotonic()
+    try:
+        for n, line in enumerate(read_lines(paths, opts.get('limit')), 1):
+            item = dumputil.decode_dynamodb_item(line)
+            for k in key_names:
+                if k not in item:
+                    raise ValueError(f'item {n} has no key attribute {k}')
+            for k in binary_keys:
+                item[k] = { 'B': base64.b64decode(item[k]['S']) }
+            worker = hash(next(iter(item[partition_key].values()))) % workers
+            # A write capacity unit covers 1 KB; the dumped JSON is about
+            # the size of the item.
+            batchers[worker].put((item, math.ceil(len(line) / 1024)))
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        close_all(batchers)
+    print_loaded(sum(loaded), table, start)
+
+########################################################################
+# Kinesis
+
+def list_open_shards(client, stream):
+    shards = []
+    opts = { 'StreamName': stream }
+    while True:
+        r = client.list_shards(**opts)
+        shards += [s for s in r['Shards'] if 'EndingSequenceNumber' not in s['SequenceNumberRange']]
+        if not r.get('NextToken'):
+            break
+        opts = { 'NextToken': r['NextToken'] }
+    return sorted(shards, key=lambda s: int(s['HashKeyRange']['StartingHashKey']))
+
+def put_records(client, stream, records, puts, writes, stop):
+    """Puts a batch of records with PutRecords, retrying failed records.
+
+    Returns False if the stop event was set before every record was put.
+    """
+    while records:
+        size = sum(len(d['Data']) + len(d['PartitionKey']) for d in records)
+        if not puts.acquire(len(records), stop) or not writes.acquire(size, stop):
+            return False
+        try:
+            r = client.put_records(StreamName=stream, Records=records)
+        except client.exceptions.ProvisionedThroughputExceededException as e:
+            print(f'{bcolors.WARNING}caught {e}{bcolors.ENDC}', file=sys.stderr)
+            writes.throttled()
+            stop.wait(puts.throttled())
+            continue
+        failed = [d for d, result in zip(records, r['Records']) if 'ErrorCode' in result]
+        if failed:
+            # Records fail when the shard is throttled or has an internal
+            # error; back off before putting them again.
+            if debug: print(f'{bcolors.GREY20}{len(failed)} of {len(records)} records failed: {r["Records"][0].get("ErrorCode")}{bcolors.ENDC}', file=sys.stderr)
+            writes.throttled()
+            stop.wait(puts.throttled())
+        else:
+            puts.succeeded()
+            writes.succeeded()
+        records = failed
+    return True
+
+def jmespath_expression(expression):
+    # Only checks the expression; it's compiled again where it's used.
+    import jmespath
+    jmespath.compile(expression)
+    return expression
+
+def load_stream(stream, paths, profile, **opts):
+    client = dumputil.aws_client('kinesis', profile, opts.get('endpoint_url'))
+
+    shards = list_open_shards(client, stream)
+    if debug: print(f'{bcolors.GREY20}{len(shards)} open shards{bcolors.ENDC}', file=sys.stderr)
+    starts = [int(s['HashKeyRange']['StartingHashKey']) for s in shards]
+    stop = threading.Event()
+
+    # Each shard is written by its own thread, at a fraction of the shard's
+    # write limits, in batches of at most a second's worth so that a batch
+    # isn't throttled just for being put all at once.
+    fraction = opts.get('capacity_fraction') or 1
+    max_count = max(1, min(put_records_count, int(shard_write_records * fraction)))
+    max_bytes = max(1, min(put_records_bytes, int(shard_write_bytes * fraction)))
+    loaded = [0] * len(shards)
+    def sender(i):
+        puts = dumputil.RateLimiter(shard_write_records * fraction)
+        writes = dumputil.RateLimiter(shard_write_bytes * fraction)
+        def send(records):
+            if put_records(client, stream, records, puts, writes, stop):
+                loaded[i] += len(records)
+        return send
+    batchers = [dumputil.Batcher(sender(i), max_count, max_bytes) for i in range(len(shards))]
+
+    partition_key = None
+    if opts.get('partition_key'):
+        import jmespath
+        partition_key = jmespath.compile(opts['partition_key'])
+
+    start = time.monotonic()
+    try:
+        for line in read_lines(paths, opts.get('limit')):
+            d = None
+            if opts.get('full_event') or partition_key:
+                d = json.loads(line)
+            if opts.get('full_event'):
+                data = json.dumps(d['Data'], separators=(',', ':')).encode('utf-8')
+            else:
+                # The line is the record's JSON as it was dumped.
+                data = line.strip()
+            if partition_key:
+                key = partition_key.search(d)
+                if key is None:
+                    raise ValueError(f'--partition-key {opts["partition_key"]} is null for {line[:200]!r}')
+                key = key if isinstance(key, str) else json.dumps(key)
+            elif opts.get('full_event'):
+                key = d['PartitionKey']
+            else:
+                key = f'{random.getrandbits(128):032x}'
+            if opts.get('base64'):
+                data = base64.b64encode(data)
+            # Kinesis maps the MD5 hash of the partition key to a shard.
+            # https://docs.aws.amazon.com/kinesis/latest/APIReference/API_PutRecordsRequestEntry.html
+            shard = bisect.bisect_right(starts, int.from_bytes(hashlib.md5(key.encode('utf-8')).digest(), 'big')) - 1
+            batchers[shard].put({ 'Data': data, 'PartitionKey': key }, len(data) + len(key))
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        close_all(batchers)
+    print_loaded(sum(loaded), stream, start)
+
+########################################################################
+
+parser = argparse.ArgumentParser(description='Load the ndjson output of dynamodb-dump.py or kinesis-dump.py into a table or stream.')
+parser.add_argument('service', choices=['dynamodb', 'kinesis'])
+parser.add_argument('target', help='table or stream to write to')
+parser.add_argument('files', nargs='*', metavar='FILE', help='ndjson files, optionally compressed with gzip or zstd (default stdin)')
+parser.add_argument(
+    '-p', '--profile', default=default_profile,
+    help=f'specify AWS profile (default {default_profile})')
+parser.add_argument(
+    '--endpoint-url', metavar='URL',
+    help='send requests to URL instead of AWS, e.g. a local moto server')
+parser.add_argument(
+    '-n', '--limit', type=int,
+    help='stop after loading this many records')
+parser.add_argument(
+    '--capacity-fraction', type=float, default=1,
+    help='fraction of the table\'s write capacity, or of each shard\'s write limits (1000 records/s, 1 MB/s), to use (default 1)')
+parser.add_argument(
+    '--write-capacity', type=float,
+    help='dynamodb: write capacity units per second to base --capacity-fraction on (default the provisioned capacity, or 1000 for on-demand tables)')
+parser.add_argument(
+    '--workers', type=int,
+    help='dynamodb: number of threads writing batches (default 8)')
+parser.add_argument(
+    '--full-event', action='store_true',
+    help='kinesis: the input was dumped with --full-event; the records keep their PartitionKey')
+parser.add_argument(
+    '--partition-key', type=jmespath_expression, metavar='EXPRESSION',
+    help='kinesis: JMESPath expression giving the partition key of each record as it was dumped, e.g. "merchantId" (default the PartitionKey with --full-event, otherwise random)')
+parser.add_argument(
+    '--base64', action='store_true',
+    help='kinesis: base64-encode the JSON of each record, like the producers of fbt-event do')
+parser.add_argument(
+    '--debug', action='store_true')
+args = parser.parse_intermixed_args()
+if args.service == 'dynamodb' and (args.full_event or args.partition_key or args.base64):
+    parser.error('--full-event, --partition-key and --base64 only apply to kinesis')
+if args.service == 'kinesis' and (args.write_capacity or args.workers):
+    parser.error('--write-capacity and --workers only apply to dynamodb')
+
+debug = args.debug
+
+if args.service == 'dynamodb':
+    load_table(
+        args.target,
+        args.files,
+        profile=args.profile,
+        endpoint_url=args.endpoint_url,
+        limit=args.limit,
+        capacity_fraction=args.capacity_fraction,
+        write_capacity=args.write_capacity,
+        workers=args.workers)
+else:
+    load_stream(
+        args.target,
+        args.files,
+        profile=args.profile,
+        endpoint_url=args.endpoint_url,
+        limit=args.limit,
+        capacity_fraction=args.capacity_fraction,
+        full_event=args.full_event,
+        partition_key=args.partition_key,
+        base64=args.base64)
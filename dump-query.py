@@ -0,0 +1,128 @@
+#! /usr/bin/env python3
+
+# Answers ad-hoc queries from a local cache of dumped tables and streams, so
+# that looking at the same data again doesn't mean dumping it from AWS again.
+#
+# The cache is a SQLite file that dynamodb-dump.py and kinesis-dump.py add
+# to with `--format sqlite --output CACHE`.  Each dump becomes a table named
+# after the DynamoDB table or Kinesis stream, with the record as JSON in the
+# `item` column and indexed copies of the table's key attributes, or of the
+# stream's SequenceNumber, PartitionKey and ApproximateArrivalTimestamp:
+#   dynamodb-dump.py merchants -f sqlite -o cache.db
+#   kinesis-dump.py fbt-event --all-shards --since 1h -f sqlite -o cache.db
+#   dump-query.py cache.db "SELECT item FROM merchants WHERE id = 'm123'"
+#   dump-query.py cache.db --ttl 10m "SELECT PartitionKey, count(*) FROM \"fbt-event\"
+#       WHERE json_extract(item, '$.Data.merchantId') = 'm123' GROUP BY 1"
+#
+# Dumps that a query uses and that are older than --ttl are run again, with
+# the same arguments, before the query.
+
+import argparse
+import json
+import re
+import sqlite3
+import subprocess
+import sys
+import time
+
+class bcolors:
+    WARNING     = '\033[93m'    # bright yellow
+    ENDC        = '\033[0m'
+    GREY20      = f'\033[38;5;{232 + 20}m'
+
+def parse_ttl(ttl):
+    """Parses a number of seconds, with optional suffix m:minutes, h:hours, d:days."""
+    multiplier = {
+        '': 1,
+        's': 1,
+        'm': 60,
+        'h': 3600,
+        'd': 24 * 3600,
+    }
+    match = re.match(r'^(\d+)([smhd]?)$', ttl)
+    if not match:
+        raise ValueError('ttl is not in format "INT[smhd]?"')
+    return int(match.group(1)) * multiplier[match.group(2)]
+
+def format_age(seconds):
+    for unit, size in (('d', 24 * 3600), ('h', 3600), ('m', 60)):
+        if seconds >= size:
+            return f'{seconds / size:.1f}{unit}'
+    return f'{seconds:.0f}s'
+
+def list_dumps(db):
+    try:
+        rows = db.execute('SELECT name, command, cwd, dumped FROM _dumps ORDER BY name').fetchall()
+    except sqlite3.OperationalError:
+        # Nothing has been dumped to this cache yet.
+        return {}
+    return { name: { 'command': json.loads(command), 'cwd': cwd, 'dumped': dumped }
+             for name, command, cwd, dumped in rows }
+
+def used_dumps(dumps, sql):
+    """Returns the names of the dumps the query refers to."""
+    return [name for name in dumps
+            if re.search(r'(?<![\w$])' + re.escape(name) + r'(?![\w$])', sql)]
+
+def refresh(name, dump):
+    print(f'{bcolors.GREY20}refreshing {name}, dumped {format_age(time.time() - dump["dumped"])} ago{bcolors.ENDC}', file=sys.stderr)
+    subprocess.run([sys.executable] + dump['command'], cwd=dump['cwd'], stdout=subprocess.DEVNULL, check=True)
+
+def print_dumps(db, dumps):
+    now = time.time()
+    for name, dump in dumps.items():
+        count = db.execute(f'SELECT count(*) FROM {sql_name(name)}').fetchone()[0]
+        print(f'{name}\t{count} rows\tdumped {format_age(now - dump["dumped"])} ago\t{" ".join(dump["command"])}')
+
+def sql_name(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def print_rows(cursor, format):
+    names = [d[0] for d in cursor.description]
+    if format == 'tsv':
+        print('\t'.join(names))
+    for row in cursor:
+        if format == 'tsv':
+            print('\t'.join('' if v is None else str(v) for v in row))
+        elif len(row) == 1 and isinstance(row[0], str) and row[0][:1] in ('{', '['):
+            # A single column of JSON, e.g. `SELECT item`, is printed as is.
+            print(row[0])
+        else:
+            print(json.dumps(dict(zip(names, row)), separators=(',', ':')))
+
+########################################################################
+
+parser = argparse.ArgumentParser(description='Query the local cache of dumped tables and streams.')
+parser.add_argument('cache', help='SQLite file written with --format sqlite --output')
+parser.add_argument('sql', nargs='?', help='query to run; without one, lists the dumps in the cache')
+parser.add_argument(
+    '--ttl', type=parse_ttl, default=parse_ttl('1h'),
+    help='dump the tables and streams used by the query again if they are older than this many seconds, with optional suffix m:minutes, h:hours, d:days (default 1h)')
+refresh_group = parser.add_mutually_exclusive_group()
+refresh_group.add_argument(
+    '--refresh', action='store_true',
+    help='dump the tables and streams used by the query again whatever their age')
+refresh_group.add_argument(
+    '--no-refresh', action='store_true',
+    help='use the cache as it is')
+parser.add_argument(
+    '-f', '--format', choices=['tsv', 'ndjson'], default='tsv',
+    help='output format (default tsv)')
+args = parser.parse_intermixed_args()
+
+db = sqlite3.connect(args.cache)
+dumps = list_dumps(db)
+
+if not args.sql:
+    print_dumps(db, dumps)
+    sys.exit()
+
+if not args.no_refresh:
+    for name in used_dumps(dumps, args.sql):
+        if args.refresh or time.time() - dumps[name]['dumped'] > args.ttl:
+            refresh(name, dumps[name])
+
+try:
+    print_rows(db.execute(args.sql), args.format)
+except sqlite3.Error as e:
+    sys.exit(f'{bcolors.WARNING}{e}{bcolors.ENDC}')
@@ -0,0 +1,1566 @@
+# Helpers shared by dynamodb-dump.py and kinesis-dump.py.
+#
+# The dump scripts have hyphens in their names so they can't import each
+# other; anything both of them need lives here.  Python puts the directory
+# of the script being run (with symlinks resolved) at the front of sys.path,
+# so `import dumputil` works no matter where the scripts are run from.
+
+import base64
+import collections
+import contextlib
+import functools
+import gzip
+import importlib.util
+import io
+import json
+import math
+import os
+import queue
+import random
+import re
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from decimal import Decimal
+
+
+# Startup time matters because the dump scripts are run in shell loops, so
+# modules that take a while to import (botocore, boto3, pprint, the output
+# format libraries) are only imported when they're used.
+
+@functools.lru_cache(maxsize=None)
+def aws_session(profile):
+    botocore = import_optional('botocore.session', 'AWS access')
+    return botocore.session.Session(profile=profile)
+
+@functools.lru_cache(maxsize=None)
+def aws_client(service, profile, endpoint_url=None):
+    """Returns a botocore client, creating one per service and profile."""
+    return aws_session(profile).create_client(service, endpoint_url=endpoint_url)
+
+class LazyPrettyPrinter:
+    """A pprint.PrettyPrinter that is only created when it's first used."""
+
+    def __init__(self, **options):
+        self.options = options
+        self.printer = None
+
+    def __getattr__(self, name):
+        if self.printer is None:
+            import pprint
+            self.printer = pprint.PrettyPrinter(**self.options)
+        return getattr(self.printer, name)
+
+
+class RateLimiter:
+    """Token bucket with an adaptive (AIMD) refill rate.
+
+    `rate` is the target number of units (read capacity units, API calls,
+    bytes, ...) per second and `burst` is the size of the bucket.  Callers
+    reserve units with acquire() before making a call, and when the real
+    cost is only known afterwards (e.g. a DynamoDB ConsumedCapacity) they
+    settle the difference with consume(); the bucket may go into debt, in
+    which case the next acquire() waits until it has been paid off.
+
+    Every throttle halves the rate (down to `min_rate`) and every successful
+    call adds `increase` back (up to the target rate), so a limiter that was
+    throttled after a burst slowly recovers to the target instead of staying
+    slow forever.  One limiter may be shared by several threads.
+    """
+
+    def __init__(self, rate, burst=None, min_rate=None, increase=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or rate
+        self.min_rate = min_rate or rate / 64
+        self.increase = increase or rate / 20
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, units=1, stop=None):
+        """Waits until `units` are available, then takes them.
+
+        Requests larger than the bucket only wait for a full bucket and
+        leave it in debt.  Returns False without taking anything if the
+        `stop` event is set while waiting.
+        """
+        need = min(units, self.burst)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= need:
+                    self.tokens -= units
+                    return True
+                wait = (need - self.tokens) / self.rate
+            # A little jitter keeps threads sharing the limiter from waking
+            # up in lockstep.
+            wait *= random.uniform(1, 1.1)
+            if stop:
+                if stop.wait(wait):
+                    return False
+            else:
+                time.sleep(wait)
+
+    def consume(self, units):
+        """Charges `units` (possibly negative) without waiting."""
+        with self.lock:
+            self._refill()
+            self.tokens -= units
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttled(self, base=0.05, cap=20):
+        """Backs off after a throttling error.
+
+        Returns how many seconds the caller should sleep before retrying:
+        exponential in the number of consecutive throttles, with full
+        jitter.
+        """
+        with self.lock:
+            self.failures += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            return random.uniform(0, min(cap, base * 2 ** self.failures))
+
+
+class Checkpoint:
+    """Progress of a dump, saved as JSON so an interrupted dump can be resumed.
+
+    The position of each segment or shard is set by the thread that writes
+    the output, after the records up to that position have been written, and
+    the file is rewritten atomically every `every` pages and by save().
+    `header` identifies the dump (table, number of segments, ...); resuming
+    from a checkpoint of a different dump is an error.
+    """
+
+    def __init__(self, path, flush=None, every=10, **header):
+        self.path = path
+        self.flush = flush
+        self.every = every
+        self.header = header
+        self.positions = {}
+        self.pages = 0
+
+    def load(self):
+        """Loads the positions saved by an earlier run.
+
+        Returns False if there is no checkpoint file yet.
+        """
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return False
+        if state['header'] != self.header:
+            raise ValueError(f'checkpoint {self.path} is for {state["header"]}, not {self.header}')
+        self.positions = state['positions']
+        return True
+
+    def position(self, key):
+        return self.positions.get(str(key))
+
+    def set_position(self, key, position):
+        self.positions[str(key)] = position
+
+    def page_written(self):
+        self.pages += 1
+        if self.pages % self.every == 0:
+            self.save()
+
+    def save(self):
+        # Everything the checkpoint says was written must really be in the
+        # output.
+        sys.stdout.flush()
+        if self.flush: self.flush()
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({ 'header': self.header, 'positions': self.positions }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+# Coordinated dumps: the segments of a scan or the shards of a stream are
+# shared out among worker processes, on one host or several, through a
+# table of leases in a SQLite file.  Each worker claims a piece of work,
+# dumps it to a part file of its own, and renews its lease as it goes,
+# saving its position with it.  The lease of a worker that dies expires,
+# and another worker takes the work over from the saved position.  Once all
+# the work is done, a manifest lists the parts.
+#
+# Every claim of a piece of work writes its own part file, PART.2.ndjson
+# for the second and so on, starting from a copy of the last one up to
+# the saved position.  A worker that has lost its lease without noticing
+# yet can only write to its own file, which nothing reads any more.
+#
+# SQLite's locking makes claiming atomic between processes.  Workers on
+# other hosts need the file on a file system whose locking works, which
+# NFS's often doesn't.
+
+class LeaseLost(Exception):
+    pass
+
+class Leases:
+    """Work shared by the workers of a coordinated dump.
+
+    `header` identifies the dump (table, number of segments, ...); the
+    first worker records it, and workers of a different dump are refused.
+    A lease lasts `ttl` seconds and is renewed by a thread every third of
+    that, so a worker only loses its lease if it stops for longer.
+    """
+
+    def __init__(self, path, ttl=60, **header):
+        self.ttl = ttl
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.held = set()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS leases (
+                work TEXT PRIMARY KEY, owner TEXT, expires REAL, position TEXT, part_bytes INTEGER,
+                done INTEGER NOT NULL DEFAULT 0, records INTEGER, claims INTEGER NOT NULL DEFAULT 0, part TEXT);
+            CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+        """)
+        stored = self.setdefault('header', header)
+        if stored != json.loads(json.dumps(header)):
+            raise ValueError(f'{path} coordinates {stored}, not {header}')
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._renew, daemon=True)
+        self.thread.start()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def setdefault(self, name, value):
+        """Returns the shared value `name`, setting it to `value` if no worker has yet."""
+        with self._transaction() as db:
+            row = db.execute('SELECT value FROM state WHERE name = ?', (name,)).fetchone()
+            if row:
+                return json.loads(row[0])
+            db.execute('INSERT INTO state (name, value) VALUES (?, ?)', (name, json.dumps(value)))
+            return json.loads(json.dumps(value))
+
+    def add(self, works):
+        with self._transaction() as db:
+            db.executemany('INSERT OR IGNORE INTO leases (work) VALUES (?)', [(str(w),) for w in works])
+
+    def claim(self):
+        """Claims work that nobody holds, or whose lease has expired.
+
+        Returns (work, position, part file, part_bytes, previous owner,
+        claims), where `claims` counts this one, or None if there is none to
+        claim right now.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute("""
+                SELECT work, position, part, part_bytes, owner, claims + 1 FROM leases
+                WHERE NOT done AND (owner IS NULL OR expires < ?)
+                ORDER BY owner IS NOT NULL, rowid LIMIT 1""", (now,)).fetchone()
+            if not row:
+                return None
+            db.execute('UPDATE leases SET owner = ?, expires = ?, claims = claims + 1 WHERE work = ?',
+                       (self.owner, now + self.ttl, row[0]))
+        self.held.add(row[0])
+        return (row[0], row[1] and json.loads(row[1]), *row[2:])
+
+    def pending(self):
+        """Returns the number of pieces of work that aren't done."""
+        with self.lock:
+            return self.db.execute('SELECT count(*) FROM leases WHERE NOT done').fetchone()[0]
+
+    def _update(self, work, sql, args):
+        with self._transaction() as db:
+            updated = db.execute(f'UPDATE leases SET {sql} WHERE work = ? AND owner = ? AND NOT done',
+                                 (*args, work, self.owner)).rowcount
+        if not updated:
+            self.held.discard(work)
+            raise LeaseLost(f'lost the lease on {work} to another worker')
+
+    def save(self, work, position, part, part_bytes):
+        """Saves the position of held work, renewing the lease; raises LeaseLost if it has been taken over."""
+        self._update(work, 'position = ?, part = ?, part_bytes = ?, expires = ?',
+                     (json.dumps(position), part, part_bytes, time.time() + self.ttl))
+
+    def finish(self, work, part, part_bytes, records):
+        self._update(work, 'done = 1, expires = NULL, part = ?, part_bytes = ?, records = ?', (part, part_bytes, records))
+        self.held.discard(work)
+
+    def release(self, work):
+        """Gives up held work so that another worker can claim it straight away."""
+        try:
+            self._update(work, 'owner = NULL, expires = NULL', ())
+        except LeaseLost:
+            pass
+        self.held.discard(work)
+
+    def _renew(self):
+        while not self.stopped.wait(self.ttl / 3):
+            for work in list(self.held):
+                try:
+                    self._update(work, 'expires = ?', (time.time() + self.ttl,))
+                except LeaseLost:
+                    pass
+                except sqlite3.Error as e:
+                    print(f'cannot renew the lease on {work}: {e}', file=sys.stderr)
+
+    def write_manifest(self, path):
+        """Writes a manifest of the parts once all the work is done.
+
+        The paths of the parts are relative to the manifest's directory.
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT work, owner, part, part_bytes, records, claims FROM leases ORDER BY rowid').fetchall()
+            header = json.loads(self.db.execute("SELECT value FROM state WHERE name = 'header'").fetchone()[0])
+        manifest = {
+            **header,
+            'parts': [{ 'work': work, 'path': os.path.relpath(part, os.path.dirname(path)), 'records': records, 'bytes': part_bytes,
+                        'owner': owner, 'claims': claims }
+                      for work, owner, part, part_bytes, records, claims in rows],
+        }
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp, path)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        for work in list(self.held):
+            self.release(work)
+        self.db.close()
+
+class LeaseCheckpoint:
+    """A Checkpoint for the part of a coordinated dump that a worker holds.
+
+    Positions are saved in the lease, with the size of the part file, every
+    page.  The segments or shards that other workers dump are done as far
+    as this one is concerned.
+    """
+
+    def __init__(self, leases, work, position, part, flush=None):
+        self.leases = leases
+        self.work = work
+        self.part = part
+        self.flush = flush
+        self.positions = { work: position } if position else {}
+
+    def position(self, key):
+        return self.positions.get(str(key)) if str(key) == self.work else { 'done': True }
+
+    def set_position(self, key, position):
+        self.positions[str(key)] = position
+
+    def page_written(self):
+        self.save()
+
+    def save(self):
+        if self.work not in self.positions:
+            return
+        # Don't flush pages that the new owner of the work will dump again.
+        if self.work not in self.leases.held:
+            raise LeaseLost(f'lost the lease on {self.work} to another worker')
+        if self.flush: self.flush()
+        try:
+            part_bytes = os.path.getsize(self.part)
+        except FileNotFoundError:
+            # The new owner has copied what it needs from the part.
+            raise LeaseLost(f'lost the lease on {self.work} to another worker') from None
+        self.leases.save(self.work, self.positions[self.work], self.part, part_bytes)
+
+def work_leases(leases, dump_part, part_path, wait=5):
+    """Claims work from `leases` and dumps it until all of it is done.
+
+    `dump_part(work, path, checkpoint, append)` dumps a piece of work to the
+    part file `path`, continuing from the checkpoint's position if there is
+    one, in which case the part starts with what the last claim of the work
+    wrote up to the position and should be appended to.  The first claim's
+    part is `part_path(work)`.  While the remaining work is held by other
+    workers, this waits to take over any whose lease expires.
+    """
+    while True:
+        claim = leases.claim()
+        if claim is None:
+            if not leases.pending():
+                return
+            time.sleep(wait)
+            continue
+        work, position, part, part_bytes, previous, claims = claim
+        path = part_path(work)
+        if claims > 1:
+            root, ext = os.path.splitext(path)
+            path = f'{root}.{claims}{ext}'
+        if previous:
+            print(f'taking over {work} from {previous}', file=sys.stderr)
+        if position and part_bytes is not None and part and os.path.exists(part):
+            # Anything written after the position was saved will be dumped
+            # again.
+            with open(part, 'rb') as src, open(path, 'wb') as dst:
+                copy_bytes(src, dst, part_bytes)
+            append = True
+        else:
+            position = None
+            append = False
+        if part and os.path.exists(part):
+            os.remove(part)
+        try:
+            dump_part(work, path, LeaseCheckpoint(leases, work, position, path), append)
+            leases.finish(work, path, os.path.getsize(path), count_lines(path))
+        except LeaseLost as e:
+            print(e, file=sys.stderr)
+            continue
+        except BaseException:
+            leases.release(work)
+            raise
+
+def copy_bytes(src, dst, n):
+    """Copies the first `n` bytes of the file `src` to `dst`."""
+    while n > 0:
+        chunk = src.read(min(n, 1024 * 1024))
+        if not chunk:
+            break
+        dst.write(chunk)
+        n -= len(chunk)
+
+def count_lines(path):
+    n = 0
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            n += chunk.count(b'\n')
+    return n
+
+
+class Metrics:
+    """Counts and times the calls a dump makes, for --progress and --metrics.
+
+    Each call is recorded under a name ('scan', 'get_records', 'decode',
+    ...) with its latency and counters like the items or bytes it returned,
+    e.g.
+        with metrics.timer('scan') as m:
+            r = client.scan(...)
+            m['items'] = len(r['Items'])
+    and things that aren't calls, like throttling errors, are counted with
+    count().  Gauges hold the latest value of something, e.g. how far each
+    shard is behind.  A Metrics may be shared by several threads.
+    """
+
+    def __init__(self, **labels):
+        self.labels = labels
+        self.calls = {}
+        self.gauges = {}
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _stats(self, name):
+        return self.calls.setdefault(name, { 'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0 })
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        counts = {}
+        start = time.perf_counter()
+        yield counts
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            stats = self._stats(name)
+            stats['calls'] += 1
+            stats['seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+            for k, v in counts.items():
+                stats[k] = stats.get(k, 0) + v
+
+    def count(self, name, **counts):
+        with self.lock:
+            stats = self._stats(name)
+            for k, v in counts.items():
+                stats[k] = stats.get(k, 0) + v
+
+    def get(self, name, counter):
+        with self.lock:
+            return self.calls.get(name, {}).get(counter, 0)
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def gauge_values(self, name):
+        with self.lock:
+            return list(self.gauges.get(name, {}).values())
+
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    def write(self, path):
+        """Writes the metrics to `path`: in the Prometheus text format if it ends in .prom, as JSON otherwise.
+
+        The file is replaced atomically, as node_exporter's textfile
+        collector requires.
+        """
+        with self.lock:
+            if path.endswith('.prom'):
+                text = self._prometheus()
+            else:
+                text = json.dumps({
+                    **self.labels,
+                    'elapsed_seconds': self.elapsed(),
+                    'calls': self.calls,
+                    'gauges': { name: [{ **dict(labels), 'value': v } for labels, v in values.items()]
+                                for name, values in self.gauges.items() },
+                }, indent=2) + '\n'
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    # https://prometheus.io/docs/instrumenting/exposition_formats/
+    def _prometheus(self):
+        def metric(name, value, **labels):
+            labels = { **self.labels, **labels }
+            label_text = ','.join(f'{k}="{prometheus_escape(v)}"' for k, v in labels.items())
+            return f'dump_{name}{{{label_text}}} {value}'
+        lines = [metric('elapsed_seconds', self.elapsed())]
+        for call, stats in sorted(self.calls.items()):
+            for k, v in stats.items():
+                if k == 'max_seconds':
+                    lines.append(metric('call_max_seconds', v, call=call))
+                elif k == 'seconds':
+                    lines.append(metric('call_seconds_total', v, call=call))
+                else:
+                    lines.append(metric(f'{k}_total', v, call=call))
+        for name, values in sorted(self.gauges.items()):
+            for labels, v in values.items():
+                lines.append(metric(name, v, **dict(labels)))
+        return '\n'.join(lines) + '\n'
+
+def response_bytes(r):
+    """Returns the size of the body of a botocore response."""
+    return int(r['ResponseMetadata']['HTTPHeaders'].get('content-length', 0))
+
+def prometheus_escape(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Progress:
+    """Prints `line()` to stderr every `interval` seconds, and once more when closed."""
+
+    def __init__(self, line, interval=5):
+        self.line = line
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            print(self.line(), file=sys.stderr)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        print(self.line(), file=sys.stderr)
+
+def format_duration(seconds):
+    if seconds is None:
+        return '?'
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+    elif seconds >= 60:
+        return f'{seconds // 60}m{seconds % 60:02d}s'
+    return f'{seconds}s'
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024 or unit == 'MiB':
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
+
+
+# Sampling, for a quick look at the shape of a table or stream that is too
+# big to dump: --sample reads a random fraction of it, --sample-size keeps
+# a uniform random sample of what was read, and --stats summarizes it.
+
+class Reservoir:
+    """A uniform random sample of `size` of the records passed to extend().
+
+    Uses Li's Algorithm L, which works out how many records to skip before
+    the next one that goes into the sample, so most records cost nothing.
+    https://en.wikipedia.org/wiki/Reservoir_sampling#Optimal:_Algorithm_L
+    """
+
+    def __init__(self, size, rng=random):
+        self.size = size
+        self.rng = rng
+        self.items = []
+        self.seen = 0
+        self.weight = 1.0
+        self.next = None
+
+    def _skip(self):
+        # random() can return 0, but not 1.
+        self.weight *= math.exp(math.log(1 - self.rng.random()) / self.size)
+        self.next += math.floor(math.log(1 - self.rng.random()) / math.log(1 - self.weight)) + 1
+
+    def extend(self, records):
+        records = list(records)
+        start = 0
+        if len(self.items) < self.size:
+            start = self.size - len(self.items)
+            self.items.extend(records[:start])
+            if len(self.items) == self.size:
+                self.next = self.size - 1
+                self._skip()
+        end = self.seen + len(records)
+        while self.next is not None and self.next < end:
+            self.items[self.rng.randrange(self.size)] = records[self.next - self.seen]
+            self._skip()
+        self.seen = end
+
+class Stats:
+    """Attribute presence, type distribution and sizes of records, for --stats.
+
+    Each record is added as its size and a list of (name, type, size) for
+    its attributes, so nothing but the counts is kept.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.max_bytes = 0
+        # Records of 2**(n-1) to 2**n - 1 bytes, by n.
+        self.histogram = collections.Counter()
+        self.attributes = {}
+
+    def add(self, size, attributes):
+        self.count += 1
+        self.bytes += size
+        self.max_bytes = max(self.max_bytes, size)
+        self.histogram[int(size).bit_length()] += 1
+        for name, type, size in attributes:
+            a = self.attributes.get(name)
+            if a is None:
+                a = self.attributes[name] = { 'count': 0, 'types': collections.Counter(), 'bytes': 0, 'max_bytes': 0 }
+            a['count'] += 1
+            a['types'][type] += 1
+            a['bytes'] += size
+            a['max_bytes'] = max(a['max_bytes'], size)
+
+    def print(self, unit='records', total=None, file=sys.stdout):
+        """Prints the summary; `total` is the estimated number of records that were sampled from."""
+        line = f'{self.count} {unit} read'
+        if total is not None:
+            line += f', about {total:.0f} in all'
+        print(line, file=file)
+        if not self.count:
+            return
+        print(f'size: average {format_size(self.bytes / self.count)}, largest {format_size(self.max_bytes)}', file=file)
+        top = max(self.histogram.values())
+        for n in range(min(self.histogram), max(self.histogram) + 1):
+            low, high = (2 ** (n - 1), 2 ** n - 1) if n else (0, 0)
+            count = self.histogram[n]
+            print(f'  {format_size(low):>9} - {format_size(high):>9} {count:>9} {100 * count / self.count:5.1f}% '
+                  + '#' * math.ceil(40 * count / top), file=file)
+        if not self.attributes:
+            return
+        width = max(9, *(len(name) for name in self.attributes))
+        print(f'{"attribute":<{width}}  present  average  largest  types', file=file)
+        for name, a in sorted(self.attributes.items(), key=lambda item: (-item[1]['count'], item[0])):
+            types = ', '.join(f'{type} {100 * count / a["count"]:.1f}%' for type, count in a['types'].most_common())
+            print(f'{name:<{width}}  {100 * a["count"] / self.count:6.1f}%  {format_size(a["bytes"] / a["count"]):>7}'
+                  f'  {format_size(a["max_bytes"]):>7}  {types}', file=file)
+
+def json_type(v):
+    if isinstance(v, str):
+        return 'string'
+    elif isinstance(v, bool):
+        return 'boolean'
+    elif isinstance(v, (int, float, Decimal)):
+        return 'number'
+    elif isinstance(v, dict):
+        return 'object'
+    elif isinstance(v, list):
+        return 'array'
+    elif v is None:
+        return 'null'
+    return type(v).__name__
+
+def json_record_stats(d):
+    """Returns the size and attributes of a record as JSON, for Stats.add()."""
+    encode = json.JSONEncoder(separators=(',', ':'), default=str).encode
+    if not isinstance(d, dict):
+        return len(encode(d).encode('utf-8')), []
+    attributes = [(name, json_type(v), len(encode(v).encode('utf-8'))) for name, v in d.items()]
+    # The names, quotes, colons, commas and braces.
+    return sum(len(name.encode('utf-8')) + size + 4 for name, _, size in attributes) + 1, attributes
+
+# https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/CapacityUnitCalculations.html
+def dynamodb_value_size(v):
+    """Returns the size of a DynamoDB value in the wire format, roughly as DynamoDB counts it."""
+    (t, x), = v.items()
+    if t == 'S':
+        return len(x.encode('utf-8'))
+    elif t == 'N':
+        return (len(x.lstrip('-0').replace('.', '')) + 1) // 2 + 1
+    elif t == 'B':
+        return len(x)
+    elif t in ('BOOL', 'NULL'):
+        return 1
+    elif t == 'M':
+        return 3 + sum(len(k.encode('utf-8')) + 1 + dynamodb_value_size(e) for k, e in x.items())
+    elif t == 'L':
+        return 3 + sum(1 + dynamodb_value_size(e) for e in x)
+    elif t in ('SS', 'NS', 'BS'):
+        return sum(dynamodb_value_size({ t[0]: e }) for e in x)
+    return len(json.dumps(x, default=str))
+
+def dynamodb_item_stats(item):
+    """Returns the size and attributes of a DynamoDB item in the wire format, for Stats.add()."""
+    attributes = [(name, next(iter(v)), len(name.encode('utf-8')) + dynamodb_value_size(v))
+                  for name, v in item.items()]
+    return sum(size for _, _, size in attributes), attributes
+
+
+def decode_pool(processes):
+    """Returns a pool of `processes` worker processes for Pipelines to decode pages in.
+
+    The dump scripts can't be re-imported by spawned processes, so the pool
+    is forked, which must happen before any thread that holds locks starts:
+    a lock held while forking stays held in the worker processes.  The
+    pipeline's own thread starts after its pool; a coordinated dump makes
+    its pool before its Leases start renewing.
+    """
+    import multiprocessing
+    return multiprocessing.get_context('fork').Pool(processes, initializer=ignore_sigint)
+
+class Pipeline:
+    """Decodes and writes pages of records while the next ones are fetched.
+
+    The fetching thread hands each page to put() and goes straight back to
+    the network.  Pages are decoded by `decode(records)`, either on the
+    writer thread or, with `processes`, in a pool of worker processes, and
+    the results are passed to `write(decoded, *args)` on the writer thread
+    in the order they were put.
+
+    At most `depth` pages are queued or being decoded; put() blocks while
+    the queue is full, so a slow writer slows down fetching instead of
+    letting pages pile up in memory.  With `metrics`, the time spent
+    decoding (or waiting for the pool to) and writing is recorded as the
+    'decode' and 'write' calls.  A `pool` from decode_pool() may be given
+    instead of `processes`, and is left open.
+    """
+
+    def __init__(self, decode, write, processes=0, depth=4, metrics=None, pool=None):
+        self.decode = decode
+        self.write = write
+        self.metrics = metrics
+        self.pool = pool
+        self.owns_pool = False
+        if processes and not pool:
+            self.pool = decode_pool(processes)
+            self.owns_pool = True
+        self.pages = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, records, *args):
+        if self.error:
+            raise self.error
+        if self.pool:
+            self.pages.put((self.pool.apply_async(self.decode, (records,)), args))
+        else:
+            self.pages.put((records, args))
+
+    def _run(self):
+        while True:
+            page = self.pages.get()
+            if page is None:
+                break
+            if self.error:
+                # Keep draining so that put() never blocks on a writer that
+                # has given up.
+                continue
+            records, args = page
+            try:
+                with self._timer('decode'):
+                    decoded = records.get() if self.pool else self.decode(records)
+                with self._timer('write'):
+                    self.write(decoded, *args)
+            except BaseException as e:
+                self.error = e
+
+    def _timer(self, name):
+        return self.metrics.timer(name) if self.metrics else contextlib.nullcontext()
+
+    def close(self):
+        """Waits until every page has been written."""
+        self.pages.put(None)
+        self.thread.join()
+        if self.owns_pool:
+            self.pool.close()
+            self.pool.join()
+        if self.error:
+            raise self.error
+
+class Batcher:
+    """Collects records into batches and sends them from a thread of its own.
+
+    Records are added with put() and passed to `send(batch)` on the
+    batcher's thread once there are `max_count` of them, or `max_bytes` by
+    the sizes they were put with, or when no record has come in for
+    `linger` seconds.  Records for which `key(record)` is the same replace
+    each other within a batch, for APIs that reject duplicates in a call.
+
+    put() blocks while `depth` records are queued, so that reading the
+    input can't get far ahead of a slow destination.
+    """
+
+    def __init__(self, send, max_count, max_bytes=None, key=None, linger=0.1, depth=10000):
+        self.send = send
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.key = key
+        self.linger = linger
+        self.records = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, record, size=0):
+        if self.error:
+            raise self.error
+        self.records.put((record, size))
+
+    def _run(self):
+        batch = {}
+        batch_size = 0
+        while True:
+            try:
+                entry = self.records.get(timeout=self.linger) if batch else self.records.get()
+            except queue.Empty:
+                entry = ()
+            if entry:
+                record, size = entry
+                if self.error:
+                    # Keep draining so that put() never blocks on a sender
+                    # that has given up.
+                    continue
+                key = self.key(record) if self.key else len(batch)
+                if key in batch:
+                    batch_size -= batch[key][1]
+                elif batch and self.max_bytes and batch_size + size > self.max_bytes:
+                    self._send(batch)
+                    batch = {}
+                    batch_size = 0
+                batch[key] = (record, size)
+                batch_size += size
+                if len(batch) < self.max_count and not (self.max_bytes and batch_size >= self.max_bytes):
+                    continue
+            if batch:
+                self._send(batch)
+                batch = {}
+                batch_size = 0
+            if entry is None:
+                break
+
+    def _send(self, batch):
+        if self.error:
+            return
+        try:
+            self.send([record for record, _ in batch.values()])
+        except BaseException as e:
+            self.error = e
+
+    def close(self):
+        """Waits until every record has been sent."""
+        self.records.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+def ignore_sigint():
+    # ^C is for the main process, which stops the pool when it's done.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def read_shard_tree(list_shards, read_shard, stop, on_page, on_shard=None, on_finish=None, finished=()):
+    """Reads all the shards of a Kinesis or DynamoDB stream.
+
+    Every shard is read by its own thread, so that a long-running follow of
+    one shard doesn't starve the others.  A shard created by a split or
+    merge is only read once its parents have been read to their end, so
+    that the records for each key stay in order.
+    https://docs.aws.amazon.com/streams/latest/dev/kinesis-using-sdk-java-after-resharding.html
+
+    `list_shards()` returns the shards of the stream by id, and
+    `read_shard(shard_id, emit)` reads one of them, calling
+    `emit(shard_id, records, ...)` for every page, and returns True if it
+    reached the end of a closed shard.  The pages are passed to
+    `on_page(shard_id, records, ...)` on the calling thread; the queue of
+    pages is bounded, so readers wait for it rather than filling up memory.
+    `on_shard(shard_id)` is called for every shard listed and
+    `on_finish(shard_id, closed)` when a reader returns.  Shards in
+    `finished` were read to their end earlier and aren't read again.
+    """
+    events = queue.Queue(maxsize=4)
+    shards = {}
+    started = set()
+    done = set(finished)
+    returned = set()
+    errors = []
+
+    def reader(shard_id):
+        closed = False
+        try:
+            closed = read_shard(shard_id, lambda *page: events.put(page))
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            events.put((shard_id, None, closed))
+
+    def refresh():
+        for shard_id, shard in list_shards().items():
+            if shard_id not in shards:
+                shards[shard_id] = shard
+                if on_shard and shard_id not in done: on_shard(shard_id)
+
+    def start_ready():
+        for shard_id, shard in shards.items():
+            parents = (shard.get('ParentShardId'), shard.get('AdjacentParentShardId'))
+            # Parents that are no longer listed have aged out of the stream.
+            if shard_id not in started and shard_id not in done and \
+               all(p is None or p not in shards or p in done for p in parents):
+                started.add(shard_id)
+                threading.Thread(target=reader, args=(shard_id,), daemon=True).start()
+
+    refresh()
+    start_ready()
+    try:
+        while len(returned) < len(started):
+            page = events.get()
+            shard_id, records = page[:2]
+            if records is None:
+                closed = page[2]
+                returned.add(shard_id)
+                if closed: done.add(shard_id)
+                if on_finish: on_finish(shard_id, closed)
+                # Reading a shard to its end makes its children readable.
+                # Re-list the shards to find children created since we
+                # started.
+                if closed and not stop.is_set():
+                    refresh()
+                    start_ready()
+            else:
+                on_page(*page)
+    except BaseException:
+        stop.set()
+        raise
+    if errors:
+        raise errors[0]
+
+
+class ItemStore:
+    """A local copy of a table: JSON documents in a SQLite file, by key.
+
+    `items` holds the documents as JSON text, so that they can be read with
+    SQLite's JSON functions, e.g.
+        sqlite3 copy.db "SELECT item FROM items WHERE json_extract(item, '$.status') = 'active'"
+    and `state` holds JSON values such as the stream positions the copy is
+    up to date with.  Changes become visible, and durable, together with the
+    state on commit().
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS items (key TEXT PRIMARY KEY, item TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+        """)
+
+    def get_state(self, name, default=None):
+        row = self.db.execute('SELECT value FROM state WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_state(self, name, value):
+        self.db.execute('INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)', (name, json.dumps(value)))
+
+    def put(self, items):
+        """Inserts or replaces (key, item) pairs of JSON text."""
+        self.db.executemany('INSERT OR REPLACE INTO items (key, item) VALUES (?, ?)', items)
+
+    def delete(self, keys):
+        self.db.executemany('DELETE FROM items WHERE key = ?', [(key,) for key in keys])
+
+    def clear(self):
+        self.db.execute('DELETE FROM items')
+
+    def count(self):
+        return self.db.execute('SELECT count(*) FROM items').fetchone()[0]
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+# Output sinks.  A sink takes whole pages of records with write(), so that
+# records are encoded and written in bulk rather than printed one at a time.
+#
+#   ndjson    compact JSON, one record per line, optionally compressed
+#   parquet   columnar Parquet (requires pyarrow)
+#   arrow     Arrow IPC stream (requires pyarrow)
+#   sqlite    a table in a SQLite file, for dump-query.py
+
+sink_formats = ['ndjson', 'parquet', 'arrow', 'sqlite']
+sink_compressions = ['gzip', 'zstd']
+
+def open_sink(path=None, format='ndjson', compress=None, append=False, default=None, table=None, columns=(), key=()):
+    """Opens a sink writing to `path`, or to stdout if there is no path.
+
+    `default` is passed to json.dumps() to encode values that JSON can't
+    represent natively.  When `append` is set the output is added to the end
+    of an existing file; compressed output is appended as a new gzip member
+    or zstd frame, which decompressors read as one stream.  `table`,
+    `columns` and `key` only apply to sqlite; see SQLiteSink.
+    """
+    if format == 'sqlite':
+        if not path:
+            raise ValueError('--format sqlite requires --output')
+        if compress:
+            raise ValueError('--compress does not apply to sqlite')
+        return SQLiteSink(path, table, columns, key, default, append)
+
+    if path:
+        stream = open(path, 'ab' if append else 'wb', buffering=1024 * 1024)
+        owned = [stream]
+    else:
+        stream = sys.stdout.buffer
+        owned = []
+
+    if format == 'ndjson':
+        if compress == 'gzip':
+            stream = gzip.GzipFile(fileobj=stream, mode='wb')
+            owned.insert(0, stream)
+        elif compress == 'zstd':
+            zstandard = import_optional('zstandard', '--compress zstd')
+            stream = zstandard.ZstdCompressor().stream_writer(stream, closefd=False)
+            owned.insert(0, stream)
+        elif compress:
+            raise ValueError(f'unknown compression {compress}')
+        return NDJSONSink(stream, owned, default)
+    elif format in ('parquet', 'arrow'):
+        if compress:
+            raise ValueError(f'--compress does not apply to {format}; it is compressed internally')
+        if append:
+            raise ValueError(f'cannot append to {format} output; write to a new file')
+        return ArrowSink(stream, owned, format, default, path=path)
+    else:
+        raise ValueError(f'unknown format {format}')
+
+def open_source(path=None):
+    """Opens ndjson output for reading, from stdin if there is no path or it is `-`.
+
+    gzip and zstd compression are recognized by their magic numbers, so
+    compressed input needn't be named .gz or .zst.
+    """
+    if path and path != '-':
+        stream = open(path, 'rb', buffering=1024 * 1024)
+    else:
+        stream = sys.stdin.buffer
+    magic = stream.peek(4)[:4]
+    if magic[:2] == b'\x1f\x8b':
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    elif magic == b'\x28\xb5\x2f\xfd':
+        zstandard = import_optional('zstandard', 'zstd input')
+        # Appended dumps are several frames.
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True))
+    return stream
+
+def import_optional(module, feature):
+    try:
+        return __import__(module)
+    except ImportError as e:
+        raise ImportError(f'{feature} requires the {module} module (pip install {module})') from e
+
+def check_optional(format=None, compress=None, json_backend=None):
+    """Raises ImportError if a module that the output options need is missing.
+
+    The dump scripts call this at startup, so that a missing module is an
+    argument error rather than a failure on the writer thread once the
+    first page has been fetched.  pyarrow is only looked for, not imported,
+    since it's slow to import.
+    """
+    if format in ('parquet', 'arrow') and importlib.util.find_spec('pyarrow') is None:
+        raise ImportError(f'--format {format} requires the pyarrow module (pip install pyarrow)')
+    if compress == 'zstd':
+        import_optional('zstandard', '--compress zstd')
+    if json_backend:
+        dynamodb_item_encoder(json_backend)
+
+def json_lines(records, default=None):
+    """Encodes records as compact JSON for NDJSONSink.write_encoded()."""
+    encode = json.JSONEncoder(separators=(',', ':'), default=default).encode
+    return [encode(d).encode('utf-8') for d in records]
+
+class NDJSONSink:
+    def __init__(self, stream, owned, default=None):
+        self.stream = stream
+        self.owned = owned
+        self.encoder = json.JSONEncoder(separators=(',', ':'), default=default)
+
+    def write(self, records):
+        encode = self.encoder.encode
+        self.stream.write(''.join([encode(d) + '\n' for d in records]).encode('utf-8'))
+
+    def write_encoded(self, lines):
+        """Writes records that have already been encoded as JSON bytes."""
+        if lines:
+            self.stream.write(b'\n'.join(lines) + b'\n')
+
+    def flush(self):
+        self.stream.flush()
+        for stream in self.owned:
+            stream.flush()
+
+    def close(self):
+        self.flush()
+        for stream in self.owned:
+            stream.close()
+
+class ArrowSink:
+    """Writes records in batches of columns.
+
+    The schema is inferred from the first batch, and fields missing from a
+    record are null.
+    Numbers are written as float64, or as decimal128(38, scale) with the
+    largest scale of the batch for DynamoDB's Decimals, so that later
+    batches can hold larger ones.  Fields whose values don't have a single
+    Arrow type (e.g. DynamoDB lists of mixed types) are written as JSON
+    strings.
+
+    A later batch that doesn't fit the schema, e.g. with a new field, a
+    decimal of a larger scale or a string where there were numbers, starts
+    a new file, FILE.1.parquet after FILE.parquet and so on, with a schema
+    inferred from that batch that keeps the fields of the last one.  Fields
+    whose type changed, or that didn't fit before, are JSON strings from
+    then on.  Arrow output to stdout starts a new IPC
+    stream instead; Parquet output to stdout can't be continued.
+    """
+
+    def __init__(self, stream, owned, format, default=None, batch_size=10000, path=None):
+        self.pa = import_optional('pyarrow', f'--format {format}')
+        self.stream = stream
+        self.owned = owned
+        self.format = format
+        self.path = path
+        self.parts = 0
+        self.encoder = json.JSONEncoder(separators=(',', ':'), default=default)
+        self.batch_size = batch_size
+        self.rows = []
+        self.schema = None
+        self.json_fields = set()
+        self.misfits = set()
+        self.writer = None
+
+    def write(self, records):
+        self.rows.extend(records)
+        if len(self.rows) >= self.batch_size:
+            self._write_batch()
+
+    def _write_batch(self):
+        if not self.rows:
+            return
+        table = None
+        previous = self.schema
+        if previous is not None:
+            columns = self._fit_columns()
+            if columns is None:
+                self._next_part()
+            else:
+                table = self.pa.Table.from_arrays(columns, schema=self.schema)
+        if table is None:
+            table = self._infer_table(previous)
+            self.schema = table.schema
+            if self.format == 'parquet':
+                import pyarrow.parquet
+                self.writer = pyarrow.parquet.ParquetWriter(self.stream, self.schema)
+            else:
+                self.writer = self.pa.ipc.new_stream(self.stream, self.schema)
+        self.writer.write_table(table)
+        self.rows = []
+
+    def _column(self, name):
+        values = [row.get(name) for row in self.rows]
+        if name in self.json_fields:
+            values = [None if v is None else self.encoder.encode(v) for v in values]
+        return values
+
+    def _infer_table(self, previous=None):
+        """Returns the batch as a table of inferred types, with the fields of the `previous` schema too."""
+        names = list(dict.fromkeys(name for row in self.rows for name in row))
+        if previous is not None:
+            names = list(dict.fromkeys(previous.names + names))
+        columns = []
+        for name in names:
+            values = self._column(name)
+            if (previous is not None and previous.get_field_index(name) >= 0 and name not in self.json_fields
+                    and all(v is None for v in values)):
+                # Not in this batch: keep its type so that it needn't start another file later.
+                columns.append(self.pa.array(values, type=previous.field(name).type))
+                continue
+            try:
+                array = self.pa.array(values)
+                array = array.cast(self._widen(array.type))
+                columns.append(array)
+            except (self.pa.ArrowInvalid, self.pa.ArrowTypeError, self.pa.ArrowNotImplementedError):
+                self.json_fields.add(name)
+                columns.append(self.pa.array(self._column(name), type=self.pa.string()))
+        return self.pa.Table.from_arrays(columns, names=names)
+
+    def _widen(self, t):
+        """Returns the type to give a field whose first values have type `t`."""
+        pa = self.pa
+        if pa.types.is_integer(t) or pa.types.is_floating(t):
+            return pa.float64()
+        elif pa.types.is_decimal(t):
+            return pa.decimal128(38, t.scale) if t.bit_width == 128 else pa.decimal256(76, t.scale)
+        elif pa.types.is_struct(t):
+            return pa.struct([t.field(i).with_type(self._widen(t.field(i).type)) for i in range(t.num_fields)])
+        elif pa.types.is_list(t):
+            return pa.list_(t.value_field.with_type(self._widen(t.value_type)))
+        return t
+
+    def _fits(self, t, field_type):
+        """Returns whether values of type `t` can be written to a field of `field_type` as they are."""
+        pa = self.pa
+        if t == field_type or pa.types.is_null(t):
+            return True
+        elif pa.types.is_floating(field_type):
+            return pa.types.is_integer(t) or pa.types.is_floating(t)
+        elif pa.types.is_decimal(field_type) and pa.types.is_decimal(t):
+            return t.scale <= field_type.scale and t.precision - t.scale <= field_type.precision - field_type.scale
+        elif pa.types.is_struct(field_type) and pa.types.is_struct(t):
+            return all(field_type.get_field_index(t.field(i).name) < 0
+                       or self._fits(t.field(i).type, field_type.field(t.field(i).name).type)
+                       for i in range(t.num_fields))
+        elif pa.types.is_list(field_type) and pa.types.is_list(t):
+            return self._fits(t.value_type, field_type.value_type)
+        return False
+
+    def _fit_columns(self):
+        """Returns the columns of the batch in the schema, or None if some don't fit it.
+
+        The fields that don't fit are added to the JSON fields, unless they
+        held nothing but nulls so far.  Fields that aren't in the schema
+        don't fit it either.
+        """
+        columns = []
+        misfits = []
+        for field in self.schema:
+            values = self._column(field.name)
+            try:
+                array = self.pa.array(values)
+            except (self.pa.ArrowInvalid, self.pa.ArrowTypeError, self.pa.ArrowNotImplementedError):
+                array = None
+            if array is not None and array.type == field.type:
+                columns.append(array)
+            elif array is not None and self._fits(array.type, field.type):
+                columns.append(self.pa.array(values, type=field.type))
+            else:
+                misfits.append(field.name)
+                if field.name in self.misfits or (
+                        array is None or self._widen(array.type).id != field.type.id) and not self.pa.types.is_null(field.type):
+                    self.json_fields.add(field.name)
+        added = [name for name in dict.fromkeys(name for row in self.rows for name in row)
+                 if self.schema.get_field_index(name) < 0]
+        if not misfits and not added:
+            return columns
+        self.misfits.update(misfits)
+        if misfits:
+            print(f'{", ".join(misfits)} no longer fit the {self.format} schema', file=sys.stderr)
+        if added:
+            print(f'{", ".join(added)} not in the {self.format} schema', file=sys.stderr)
+        return None
+
+    def _next_part(self):
+        """Finishes the current file and starts the next one."""
+        self.writer.close()
+        self.schema = None
+        self.parts += 1
+        if self.path:
+            for stream in self.owned:
+                stream.close()
+            root, ext = os.path.splitext(self.path)
+            path = f'{root}.{self.parts}{ext}'
+            print(f'continuing in {path}', file=sys.stderr)
+            self.stream = open(path, 'wb', buffering=1024 * 1024)
+            self.owned = [self.stream]
+        elif self.format == 'parquet':
+            raise ValueError('the records no longer fit the Parquet schema, and Parquet written to stdout '
+                             'can\'t be continued in another file; write to --output FILE instead')
+
+    def flush(self):
+        self._write_batch()
+        self.stream.flush()
+
+    def close(self):
+        self._write_batch()
+        if self.writer is not None:
+            self.writer.close()
+        self.stream.flush()
+        for stream in self.owned:
+            stream.close()
+
+class SQLiteSink:
+    """Writes records to a table of a SQLite file.
+
+    Each record is stored as JSON in the `item` column, and its `columns`
+    fields are copied to indexed columns of their own so that lookups by
+    them are fast.  Records with the same `key` fields replace each other.
+    Unless appending, the records are loaded into TABLE.loading, which
+    replaces the table once the dump completes, so that queries never see
+    a partial table; appending to an interrupted load continues it.
+
+    A dump that completes is registered in the `_dumps` table with the time
+    it started and the command that made it, which dump-query.py runs again
+    when the data gets older than it wants.  A DynamoDB table and a Kinesis
+    stream with the same name can't share a file: a table registered by
+    another script is never replaced.
+    """
+
+    def __init__(self, path, table, columns, key=(), default=None, append=False):
+        # Pages are written by the dump's writer thread, one at a time.
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.table = table
+        self.columns = list(columns)
+        self.encoder = json.JSONEncoder(separators=(',', ':'), default=default)
+        self.started = time.time()
+
+        script = self._registered_script(table)
+        if script and script != os.path.basename(sys.argv[0]):
+            raise ValueError(f'{path} already holds {table} as dumped by {script}; write to another file')
+
+        self.key = list(key)
+        self.loading = f'{table}.loading'
+        if not append:
+            self.db.execute(f'DROP TABLE IF EXISTS {sql_name(self.loading)}')
+        elif not self.db.execute('SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?', ('table', self.loading)).fetchone():
+            self.loading = None
+        definitions = [sql_name(c) for c in self.columns] + ['item TEXT NOT NULL']
+        if key:
+            definitions.append(f'PRIMARY KEY ({", ".join(sql_name(c) for c in key)})')
+        name = sql_name(self.loading or table)
+        self.db.execute(f'CREATE TABLE IF NOT EXISTS {name} ({", ".join(definitions)})')
+        if not self.loading:
+            self._create_indexes()
+        self.insert = f'INSERT OR REPLACE INTO {name} VALUES ({", ".join("?" * (len(self.columns) + 1))})'
+
+    def _create_indexes(self):
+        for c in self.columns:
+            # The primary key already indexes its first column.
+            if not self.key or c != self.key[0]:
+                self.db.execute(f'CREATE INDEX IF NOT EXISTS {sql_name(self.table + "." + c)} '
+                                f'ON {sql_name(self.table)} ({sql_name(c)})')
+
+    def _registered_script(self, table):
+        """Returns the name of the script whose dump of `table` is registered, if any."""
+        try:
+            row = self.db.execute('SELECT command FROM _dumps WHERE name = ?', (table,)).fetchone()
+        except sqlite3.OperationalError:
+            # Nothing has been dumped to this file yet.
+            return None
+        return row and os.path.basename(json.loads(row[0])[0])
+
+    def _value(self, v):
+        if v is None or isinstance(v, (str, int, float)):
+            return v
+        elif isinstance(v, Decimal):
+            return int(v) if v == v.to_integral_value() else float(v)
+        # SQLite has no other types: store the value as JSON, or as the
+        # string it's encoded as in JSON (e.g. base64 for binary).
+        encoded = self.encoder.encode(v)
+        decoded = json.loads(encoded)
+        return decoded if isinstance(decoded, str) else encoded
+
+    def write(self, records):
+        rows = [[self._value(d.get(c)) for c in self.columns] + [self.encoder.encode(d)] for d in records]
+        self.db.executemany(self.insert, rows)
+        self.db.commit()
+
+    def write_encoded(self, lines):
+        """Writes records that have already been encoded as JSON bytes."""
+        rows = []
+        for line in lines:
+            d = json.loads(line)
+            rows.append([self._value(d.get(c)) for c in self.columns] + [line.decode('utf-8')])
+        self.db.executemany(self.insert, rows)
+        self.db.commit()
+
+    def flush(self):
+        self.db.commit()
+
+    def close(self):
+        # close() is called by the dump's finally clause, so an exception on
+        # its way out means that the dump didn't complete.  Its load is left
+        # for appending to.
+        self.db.commit()
+        if sys.exc_info()[0] is None:
+            self.db.execute('BEGIN')
+            if self.loading:
+                self.db.execute(f'DROP TABLE IF EXISTS {sql_name(self.table)}')
+                self.db.execute(f'ALTER TABLE {sql_name(self.loading)} RENAME TO {sql_name(self.table)}')
+                self._create_indexes()
+            self.db.execute('CREATE TABLE IF NOT EXISTS _dumps '
+                            '(name TEXT PRIMARY KEY, command TEXT NOT NULL, cwd TEXT NOT NULL, dumped REAL NOT NULL)')
+            command = [os.path.abspath(sys.argv[0])] + sys.argv[1:]
+            self.db.execute('INSERT OR REPLACE INTO _dumps VALUES (?, ?, ?, ?)',
+                            (self.table, json.dumps(command), os.getcwd(), self.started))
+            self.db.commit()
+        self.db.close()
+
+def sql_name(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+# Converts DynamoDB items from the wire format straight to JSON, without
+# building Decimals with TypeDeserializer and encoding them again through a
+# json.dumps() default callback.  Numbers are written exactly as DynamoDB
+# sent them, binary values are base64-encoded, and sets become lists.
+# https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Programming.LowLevelAPI.html#Programming.LowLevelAPI.DataTypeDescriptors
+
+json_number_re = re.compile(r'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?')
+
+def json_number(n):
+    if json_number_re.fullmatch(n):
+        return n
+    # Valid for DynamoDB but not for JSON, e.g. '+1' or '.5'.
+    return format(Decimal(n), 'f')
+
+encode_string = json.encoder.encode_basestring_ascii
+
+def encode_dynamodb_value(v):
+    (t, x), = v.items()
+    if t == 'S':
+        return encode_string(x)
+    elif t == 'N':
+        return json_number(x)
+    elif t == 'M':
+        return '{' + ','.join([encode_string(k) + ':' + encode_dynamodb_value(e) for k, e in x.items()]) + '}'
+    elif t == 'L':
+        return '[' + ','.join([encode_dynamodb_value(e) for e in x]) + ']'
+    elif t == 'BOOL':
+        return 'true' if x else 'false'
+    elif t == 'NULL':
+        return 'null'
+    elif t == 'SS':
+        return '[' + ','.join([encode_string(e) for e in x]) + ']'
+    elif t == 'NS':
+        return '[' + ','.join([json_number(e) for e in x]) + ']'
+    elif t == 'B':
+        return '"' + base64.b64encode(x).decode('ascii') + '"'
+    elif t == 'BS':
+        return '[' + ','.join(['"' + base64.b64encode(e).decode('ascii') + '"' for e in x]) + ']'
+    raise ValueError(f'unknown DynamoDB type {t}')
+
+def encode_dynamodb_item(item):
+    return encode_dynamodb_value({ 'M': item }).encode('ascii')
+
+# With msgspec or orjson (if it is new enough to have Fragment) the item is
+# converted to Python objects, with each number left as a pre-encoded JSON
+# fragment, and encoded in C.  Building the objects costs about as much as
+# encode_dynamodb_item() does in all, so this mostly pays off for items with
+# large strings.
+
+json_backends = ['python', 'msgspec', 'orjson']
+
+def dynamodb_value_to_python(v, raw):
+    (t, x), = v.items()
+    if t == 'S':
+        return x
+    elif t == 'N':
+        return raw(json_number(x).encode('ascii'))
+    elif t == 'M':
+        return { k: dynamodb_value_to_python(e, raw) for k, e in x.items() }
+    elif t == 'L':
+        return [dynamodb_value_to_python(e, raw) for e in x]
+    elif t == 'BOOL':
+        return x
+    elif t == 'NULL':
+        return None
+    elif t == 'SS':
+        return x
+    elif t == 'NS':
+        return [raw(json_number(e).encode('ascii')) for e in x]
+    elif t == 'B':
+        return base64.b64encode(x).decode('ascii')
+    elif t == 'BS':
+        return [base64.b64encode(e).decode('ascii') for e in x]
+    raise ValueError(f'unknown DynamoDB type {t}')
+
+def dynamodb_item_encoder(backend='python'):
+    """Returns a function that converts a DynamoDB item to a line of JSON bytes."""
+    if backend == 'msgspec':
+        msgspec = import_optional('msgspec', '--json-backend msgspec')
+        import msgspec.json
+        encode = msgspec.json.Encoder().encode
+        return lambda item: encode(dynamodb_value_to_python({ 'M': item }, msgspec.Raw))
+    elif backend == 'orjson':
+        orjson = import_optional('orjson', '--json-backend orjson')
+        if not hasattr(orjson, 'Fragment'):
+            raise ImportError('--json-backend orjson requires orjson 3.9 or later')
+        return lambda item: orjson.dumps(dynamodb_value_to_python({ 'M': item }, orjson.Fragment))
+    elif backend == 'python':
+        return encode_dynamodb_item
+    raise ValueError(f'unknown JSON backend {backend}')
+
+# The other way, for loading a dump back into a table: JSON numbers become
+# N, objects M and arrays L.  The dump wrote sets as arrays and binary
+# values as base64 strings, so they are loaded as L and S.
+
+def json_to_dynamodb_value(v):
+    if isinstance(v, str):
+        return { 'S': v }
+    elif isinstance(v, bool):
+        return { 'BOOL': v }
+    elif isinstance(v, (int, Decimal)):
+        return { 'N': str(v) }
+    elif isinstance(v, dict):
+        return { 'M': { k: json_to_dynamodb_value(e) for k, e in v.items() } }
+    elif isinstance(v, list):
+        return { 'L': [json_to_dynamodb_value(e) for e in v] }
+    elif v is None:
+        return { 'NULL': True }
+    raise ValueError(f'cannot convert {v!r} to a DynamoDB value')
+
+def decode_dynamodb_item(line):
+    """Converts a line of ndjson written by dynamodb-dump.py to a DynamoDB item."""
+    # Decimals keep the numbers exactly as they were written.
+    return json_to_dynamodb_value(json.loads(line, parse_float=Decimal))['M']
+
+def encode_dynamodb_items(items, backend='python'):
+    """Encodes a page of items; for decoding in a Pipeline's worker processes."""
+    encode = dynamodb_item_encoder(backend)
+    return [encode(d) for d in items]
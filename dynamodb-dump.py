@@ -2,30 +2,28 @@
 
 default_profile = 'fbot-sandbox'
 debug = False
+metrics = None
 
 import datetime
 import time
 
 import argparse
+import base64
+import collections
+import functools
 import json
 import os
-import pathlib
-import pprint
+import queue
+import random
+import re
 import sys
+import threading
 
-pp = pprint.PrettyPrinter(indent=4, compact=True)
+# botocore and boto3 are imported when they're first used; see dumputil.
+# Run ./setup and activate venv3 to install them.
+import dumputil
 
-# Use awscli's virtualenv if we're not already running in one.
-# This works until awscli-2.1.18, when the activate_this.py module was removed/moved.
-if 'VIRTUAL_ENV' not in os.environ:
-    print('using awscli virtualenv', file=sys.stderr)
-    # aws and activate_this.py's paths are something like:
-    #   /usr/local/Cellar/awscli/2.1.18/libexec/bin/aws
-    #   /usr/local/Cellar/awscli/2.1.18/libexec/bin/activate_this.py
-    # This was broken in awscli 2.1.18 when activate_this was moved to:
-    #   /usr/local/Cellar/awscli/2.1.18/libexec/lib/python3.9/site-packages/virtualenv/activation/python/activate_this.py
-    activate_script = pathlib.Path('/usr/local/bin/aws').resolve().parent.joinpath('activate_this.py')
-    exec(open(activate_script).read(), dict(__file__=activate_script))
+pp = dumputil.LazyPrettyPrinter(indent=4, compact=True)
 
 class bcolors:
     HEADER      = '\033[95m'    # bright magenta
@@ -47,69 +45,600 @@ class bcolors:
 # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/core/session.html
 # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html
 
-import botocore.session
-import botocore.exceptions
-
 # https://stackoverflow.com/questions/36558646/how-to-convert-from-dynamodb-wire-protocol-to-native-python-object-manually-with
-try:
-    from boto3.dynamodb.types import TypeDeserializer
-except ImportError as e:
-    # Location in awscli v2
-    from awscli.customizations.dynamodb.types import TypeDeserializer
-
-
-def dump_table(table, profile, **opts):
+@functools.lru_cache(maxsize=None)
+def dynamodb_types():
+    try:
+        import boto3.dynamodb.types as types
+    except ImportError as e:
+        # Location in awscli v2
+        import awscli.customizations.dynamodb.types as types
+    return types
+
+# On-demand tables have no provisioned read capacity; default to what a
+# single partition can serve.
+on_demand_read_capacity = 3000 # RCU per second
+
+# --sample splits the scan into this many segments and scans a random
+# fraction of them, a few at a time.  DynamoDB assigns items to segments by
+# the hash of their partition key, so each segment is a random subset of the
+# table.
+sample_segments = 1000
+sample_workers = 16
+# --sample-size alone scans enough segments to expect this many times the
+# sample size, going by the table's ItemCount, and then twice as many again
+# as long as it's short, since a table with few partition keys has few
+# segments with items in them.
+sample_oversampling = 4
+
+def find_index(description, index):
+    for i in description.get('GlobalSecondaryIndexes', []) + description.get('LocalSecondaryIndexes', []):
+        if i['IndexName'] == index:
+            return i
+    raise ValueError(f'table {description["TableName"]} has no index {index}')
+
+def read_limiter(description, **opts):
+    # Global secondary indexes have their own provisioned throughput; local
+    # ones share the table's.
+    throughput = description['ProvisionedThroughput']
+    if opts.get('index'):
+        throughput = find_index(description, opts['index']).get('ProvisionedThroughput', throughput)
+    capacity = opts.get('read_capacity') or throughput['ReadCapacityUnits'] or on_demand_read_capacity
+    rate = capacity * (opts.get('capacity_fraction') or 0.5)
+    if debug: print(f'{bcolors.GREY20}reading at most {rate} RCU/s{bcolors.ENDC}', file=sys.stderr)
+    return dumputil.RateLimiter(rate)
+
+# Builds the parameters of the scan or query calls from the --attributes,
+# --filter, --names, --values, --index, --query and --key-condition options.
+# https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.html
+def read_request(description, **opts):
+    request = {}
+    names = dict(opts.get('names') or {})
+    serializer = dynamodb_types().TypeSerializer()
+    values = { k: serializer.serialize(v) for k, v in (opts.get('values') or {}).items() }
+
+    if opts.get('attributes'):
+        request['ProjectionExpression'] = projection_expression(opts['attributes'], names)
+    if opts.get('filter'):
+        request['FilterExpression'] = opts['filter']
+    if opts.get('index'):
+        request['IndexName'] = opts['index']
+
+    if opts.get('key_condition'):
+        request['KeyConditionExpression'] = opts['key_condition']
+    elif opts.get('query') is not None:
+        # Query the partition with the given value of the partition key of
+        # the table or index.
+        key_schema = find_index(description, opts['index'])['KeySchema'] if opts.get('index') else description['KeySchema']
+        key = next(k['AttributeName'] for k in key_schema if k['KeyType'] == 'HASH')
+        key_type = next(a['AttributeType'] for a in description['AttributeDefinitions'] if a['AttributeName'] == key)
+        names['#pk'] = key
+        values[':pk'] = { key_type: base64.b64decode(opts['query']) if key_type == 'B' else opts['query'] }
+        request['KeyConditionExpression'] = '#pk = :pk'
+
+    if names: request['ExpressionAttributeNames'] = names
+    if values: request['ExpressionAttributeValues'] = values
+    return request
+
+def projection_expression(attributes, names):
+    """Converts comma-separated attribute paths, like `a,b.c,d[0]`, to a ProjectionExpression.
+
+    Every attribute name is replaced with a placeholder, so that names that
+    are reserved words don't need quoting, and the placeholders are added to
+    `names`.
+    """
+    placeholders = { name: placeholder for placeholder, name in names.items() }
+    paths = []
+    for path in attributes.split(','):
+        elements = []
+        for element in path.strip().split('.'):
+            match = re.match(r'^([^\[\]]+)((?:\[\d+\])*)$', element)
+            if not match:
+                raise ValueError(f'bad attribute path {path}')
+            name = match.group(1)
+            if name not in placeholders:
+                placeholders[name] = f'#p{len(placeholders)}'
+                names[placeholders[name]] = name
+            elements.append(placeholders[name] + match.group(2))
+        paths.append('.'.join(elements))
+    return ', '.join(paths)
+
+def scan_segment(client, table, emit, stop, limiter, segment=0, total_segments=None, start_key=None, **opts):
     limit = opts.get('limit')
-    delay = opts.get('delay', 30) # seconds
-
-    session = botocore.session.Session(profile=profile)
-    client = session.create_client('dynamodb')
-
-    deser = TypeDeserializer()
+    delay = opts.get('delay') # seconds
 
     more_data = True
     i = 0
     n = 0
-    start_key = None
-    while more_data:
-        if debug: print(f'{bcolors.GREY20}fetch {i} n:{n} with delay:{delay}{bcolors.ENDC}', file=sys.stderr)
-
-        scan_opts = {}
+    # The capacity the next page is expected to use: what the last one did.
+    estimate = 1
+    while more_data and not stop.is_set():
+        if debug: print(f'{bcolors.GREY20}segment {segment} fetch {i} n:{n} with rate:{limiter.rate:.1f}{bcolors.ENDC}', file=sys.stderr)
+
+        scan_opts = dict(opts.get('request', {}))
+        if total_segments:
+            scan_opts['Segment'] = segment
+            scan_opts['TotalSegments'] = total_segments
         if limit: scan_opts['Limit'] = limit - n
         if start_key: scan_opts['ExclusiveStartKey'] = start_key
 
+        # Reserve the capacity this page is expected to use, and settle the
+        # difference once the scan reports what it actually consumed.
+        if not limiter.acquire(estimate, stop):
+            break
+        call = 'query' if 'KeyConditionExpression' in scan_opts else 'scan'
         try:
-            r = client.scan(TableName=table, **scan_opts)
+            with metrics.timer(call) as m:
+                r = getattr(client, call)(TableName=table, ReturnConsumedCapacity='TOTAL', **scan_opts)
+                m['items'] = len(r['Items'])
+                m['scanned'] = r['ScannedCount']
+                m['bytes'] = dumputil.response_bytes(r)
+                m['consumed_capacity'] = r['ConsumedCapacity']['CapacityUnits']
 
             # pp.pprint(r)
             # print("=====")
 
-            for d in r['Items']:
-                n += 1
-                # print(f'\n{bcolors.GREY10}record {n}:{bcolors.ENDC}')
-                # pp.pprint(json.loads(d['Data']))
-                # pp.pprint(d)
-                # pp.pprint(deser.deserialize({'M': d}))
-                print(json.dumps(deser.deserialize({'M': d}), default=defaultencode))
+            consumed = r['ConsumedCapacity']['CapacityUnits']
+            limiter.consume(consumed - estimate)
+            limiter.succeeded()
+            estimate = consumed
 
             start_key = r.get('LastEvaluatedKey', {})
 
+            emit(segment, r['Items'], start_key)
+            n += len(r['Items'])
+
         except client.exceptions.ProvisionedThroughputExceededException as e:
             print(f'{bcolors.WARNING}caught {e}{bcolors.ENDC}', file=sys.stderr)
-            delay = delay * 2
+            metrics.count(call, throttles=1)
+            # Wait on the stop event rather than sleeping so that other
+            # segments can end the scan early, then retry the same page.
+            stop.wait(limiter.throttled())
+            i += 1
+            continue
 
         if not start_key:
             more_data = False
         elif limit and n >= limit:
             more_data = False
-        else:
-            # Sleep to avoid exceeding 5-calls-per-second limit.  This
-            # rate-limit is applied across all consumers, and clients will
-            # receive ProvisionedThroughputExceededException if it is
-            # exceeded.
-            time.sleep(delay)
+        elif delay:
+            stop.wait(delay)
         i += 1
 
+def dump_table(table, profile, **opts):
+    limit = opts.get('limit')
+    segments = opts.get('segments') or 1
+
+    client = dumputil.aws_client('dynamodb', profile, opts.get('endpoint_url'))
+
+    description = client.describe_table(TableName=table)['Table']
+    if debug: print(f'{bcolors.GREY20}table\n{pp.pformat(description)}{bcolors.ENDC}', file=sys.stderr)
+    # The key attributes are those of the table plus those of the index
+    # being read, if any.
+    key_names = [k['AttributeName'] for k in description['KeySchema']]
+    if opts.get('index'):
+        key_names += [k['AttributeName'] for k in find_index(description, opts['index'])['KeySchema']
+                      if k['AttributeName'] not in key_names]
+
+    item_count = (find_index(description, opts['index']) if opts.get('index') else description).get('ItemCount')
+    sample = opts.get('sample')
+    if opts.get('sample_size') and not sample:
+        sample = min(1, sample_oversampling * opts['sample_size'] / item_count) if item_count else 1
+    sampled = None
+    if sample:
+        # The segments in the order they're sampled in.
+        sample_order = random.sample(range(segments), segments)
+        sampled = set(sample_order[:max(1, round(sample * segments))])
+        opts['workers'] = opts.get('workers') or min(len(sampled), sample_workers)
+        print(f'{bcolors.GREY20}scanning {len(sampled)} of {segments} segments{bcolors.ENDC}', file=sys.stderr)
+
+    opts['request'] = read_request(description, **opts)
+    if debug: print(f'{bcolors.GREY20}request\n{pp.pformat(opts["request"])}{bcolors.ENDC}', file=sys.stderr)
+
+    # All segments share one limiter, so together they stay within the
+    # table's read capacity.
+    limiter = read_limiter(description, **opts)
+
+    # Set once the limit has been reached so that the scanning segments stop
+    # fetching more pages.
+    stop = threading.Event()
+
+    sink = dumputil.open_sink(
+        opts.get('output'), opts.get('format') or 'ndjson', opts.get('compress'),
+        append=opts.get('resume'), default=defaultencode,
+        table=table, columns=key_names, key=key_names)
+
+    # The checkpoint records, for each segment, the key to continue the scan
+    # from, or that the segment is done.  It's only updated once a page has
+    # been written so that resuming neither skips nor repeats items.  A
+    # worker of a coordinated dump checkpoints to its lease instead, and
+    # sees every segment but the one it holds as done.
+    checkpoint = None
+    start_keys = {}
+    if opts.get('lease'):
+        checkpoint = opts['lease']
+        checkpoint.flush = sink.flush
+    elif opts.get('checkpoint'):
+        checkpoint = dumputil.Checkpoint(opts['checkpoint'], sink.flush, table=table, segments=segments)
+        if opts.get('resume') and not checkpoint.load():
+            print(f'{bcolors.WARNING}no checkpoint {opts["checkpoint"]}; starting from the beginning{bcolors.ENDC}', file=sys.stderr)
+    if checkpoint:
+        for segment in range(segments):
+            position = checkpoint.position(segment)
+            if position and position.get('done'):
+                start_keys[segment] = None
+            elif position:
+                start_keys[segment] = decode_key(position['ExclusiveStartKey'])
+    if sampled:
+        for segment in range(segments):
+            if segment not in sampled:
+                start_keys[segment] = None
+
+    # Pages are decoded and written by a pipeline, so that the next page is
+    # fetched while the last one is being decoded.  ndjson and sqlite are
+    # converted from the wire format straight to JSON; the other formats
+    # need Python objects.
+    def write(decoded, segment, start_key):
+        # pp.pprint(decoded)
+        if encoded:
+            sink.write_encoded(decoded)
+        else:
+            sink.write(decoded)
+        metrics.count('write', items=len(decoded))
+        if checkpoint and start_key is not None:
+            checkpoint.set_position(segment,
+                { 'ExclusiveStartKey': encode_key(start_key) } if start_key else { 'done': True })
+            checkpoint.page_written()
+
+    encoded = (opts.get('format') or 'ndjson') in ('ndjson', 'sqlite')
+    if encoded:
+        decode = functools.partial(dumputil.encode_dynamodb_items, backend=opts.get('json_backend') or 'python')
+    else:
+        decode = deserialize_items
+    pipeline = dumputil.Pipeline(decode, write, opts.get('decode_processes'), metrics=metrics, pool=opts.get('pool'))
+
+    # --stats summarizes the items as they are read, and only writes them
+    # with --output.  --sample-size holds on to a sample of them until the
+    # scan is done.
+    stats = dumputil.Stats() if opts.get('stats') else None
+    writing = not stats or opts.get('output')
+    reservoir = dumputil.Reservoir(opts['sample_size']) if opts.get('sample_size') else None
+
+    n = 0
+    def emit(segment, items, start_key):
+        nonlocal n
+        if limit and len(items) > limit - n:
+            items = items[:limit - n]
+            # Continue from the last item that was written, unless the
+            # projection left out its key.
+            if items and all(k in items[-1] for k in key_names):
+                start_key = { k: items[-1][k] for k in key_names }
+            else:
+                start_key = None
+        if stats:
+            for item in items:
+                stats.add(*dumputil.dynamodb_item_stats(item))
+        if reservoir:
+            reservoir.extend(items)
+        elif writing:
+            pipeline.put(items, segment, start_key)
+        n += len(items)
+        if limit and n >= limit:
+            stop.set()
+
+    progress = None
+    if opts.get('progress'):
+        progress = dumputil.Progress(functools.partial(
+            progress_line, 'query' if 'KeyConditionExpression' in opts['request'] else 'scan',
+            item_count and sampled and item_count * len(sampled) / segments or item_count,
+            limit))
+
+    try:
+        try:
+            scan_segments(client, table, emit, stop, limiter, start_keys, **opts)
+            while (reservoir and not opts.get('sample') and reservoir.seen < reservoir.size
+                   and len(sampled) < segments and not stop.is_set()):
+                more = sample_order[len(sampled):2 * len(sampled)]
+                sampled.update(more)
+                print(f'{bcolors.GREY20}only {reservoir.seen} items so far; scanning {len(more)} more segments{bcolors.ENDC}', file=sys.stderr)
+                scan_segments(client, table, emit, stop, limiter, { s: None for s in range(segments) if s not in more }, **opts)
+            if reservoir and reservoir.seen < reservoir.size:
+                print(f'{bcolors.WARNING}the sample has only {reservoir.seen} of the {reservoir.size} items asked for{bcolors.ENDC}', file=sys.stderr)
+            if reservoir and writing:
+                pipeline.put(reservoir.items, None, None)
+        finally:
+            pipeline.close()
+    finally:
+        try:
+            if checkpoint: checkpoint.save()
+        finally:
+            sink.close()
+            if progress: progress.close()
+    if stats:
+        stats.print('items', total=sampled and stats.count * segments / len(sampled))
+
+def coordinate_table(table, profile, **opts):
+    """Dumps the segments of a scan that the workers sharing opts['coordinate'] haven't.
+
+    Each segment is dumped to its own part file in the output directory,
+    which gets a manifest.json listing them once every segment is done.
+    """
+    directory = opts['output']
+    os.makedirs(directory, exist_ok=True)
+    # The pool of --decode-processes is shared by the parts, and forked
+    # before the leases' renewal thread starts.
+    pool = None
+    if opts.get('decode_processes'):
+        opts['pool'] = pool = dumputil.decode_pool(opts['decode_processes'])
+    leases = dumputil.Leases(opts['coordinate'], opts.get('lease_ttl') or 60,
+                             table=table, segments=opts['segments'])
+    try:
+        leases.add(range(opts['segments']))
+
+        def part_path(segment):
+            return os.path.join(directory, f'part-{int(segment):05d}.ndjson')
+
+        def dump_part(segment, path, lease, append):
+            print(f'{bcolors.GREY20}dumping segment {segment} to {path}{bcolors.ENDC}', file=sys.stderr)
+            dump_table(table, profile, **{ **opts, 'output': path, 'resume': append, 'lease': lease })
+
+        dumputil.work_leases(leases, dump_part, part_path)
+        leases.write_manifest(os.path.join(directory, 'manifest.json'))
+    finally:
+        leases.close()
+        if pool:
+            pool.close()
+            pool.join()
+
+def progress_line(call, item_count, limit):
+    """Describes how far the dump has got, for --progress.
+
+    A scan's ETA is based on the table's ItemCount, which DynamoDB updates
+    about every six hours; a query's only on the --limit.
+    """
+    elapsed = metrics.elapsed()
+    written = metrics.get('write', 'items')
+    scanned = metrics.get(call, 'scanned')
+    line = f'{written} items ({written / elapsed:.0f}/s)'
+    eta = None
+    if limit:
+        eta = (limit - written) / (written / elapsed) if written else None
+    if call == 'scan' and item_count:
+        line += f', scanned {scanned} of ~{item_count} ({min(100, 100 * scanned / item_count):.0f}%)'
+        if not limit:
+            eta = max(0, item_count - scanned) / (scanned / elapsed) if scanned else None
+    line += f', ETA {dumputil.format_duration(eta)}'
+    throttles = metrics.get(call, 'throttles')
+    if throttles:
+        line += f', {throttles} throttled'
+    return f'{bcolors.GREY20}{line}{bcolors.ENDC}'
+
+def deserialize_items(items):
+    deserializer = dynamodb_types().TypeDeserializer()
+    return [deserializer.deserialize({'M': d}) for d in items]
+
+def scan_segments(client, table, emit, stop, limiter, start_keys, **opts):
+    segments = opts.get('segments') or 1
+    workers = opts.get('workers') or segments
+
+    # Segments that are already done according to the checkpoint have a
+    # start key of None.
+    todo = [segment for segment in range(segments) if start_keys.get(segment, {}) is not None]
+
+    if segments == 1:
+        for segment in todo:
+            scan_segment(client, table, emit, stop, limiter, start_key=start_keys.get(segment), **opts)
+        return
+
+    # Parallel scan: each segment is paginated by its own worker thread
+    # (botocore clients are thread-safe), and the pages they fetch are
+    # passed on by this thread, one whole page at a time, so that the output
+    # of the segments is never interleaved within a page.
+    # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Scan.html#Scan.ParallelScan
+    pages = queue.Queue(maxsize=2 * workers)
+
+    def scan_worker(segment):
+        try:
+            scan_segment(client, table, lambda *page: pages.put(page), stop, limiter,
+                         segment, segments, start_keys.get(segment), **opts)
+        finally:
+            # Tell the writer that this segment is done.
+            pages.put(None)
+
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(scan_worker, segment) for segment in todo]
+        try:
+            remaining = len(todo)
+            while remaining:
+                page = pages.get()
+                if page is None:
+                    remaining -= 1
+                elif not stop.is_set():
+                    emit(*page)
+        except BaseException:
+            # Stop the workers and drain the queue so that none of them stays
+            # blocked on a full queue.
+            stop.set()
+            while not all(f.done() for f in futures):
+                try:
+                    pages.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            raise
+        for f in futures:
+            f.result()
+
+# Incremental sync: --sync keeps a local copy of a table in a SQLite file
+# (see dumputil.ItemStore) up to date from the table's DynamoDB Stream, so
+# that a full scan is only needed once.  The first sync scans the table and
+# then applies the stream from its oldest record; applying a change again is
+# harmless because every change carries the whole new item.  Later syncs
+# continue each shard after the last change applied.  The stream keeps
+# changes for 24 hours, so a copy that was last synced before that needs a
+# new snapshot.
+# https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Streams.html
+
+stream_retention = 24 * 3600 # seconds
+stream_read_calls = 5 # GetRecords calls per second per shard
+# GetRecords may return empty pages before later changes in the same shard,
+# so an open shard without --follow is only taken to have no more changes
+# after this many empty pages in a row, or once it has reached changes made
+# after the sync started.
+stream_empty_pages = 5
+
+def sync_table(table, profile, **opts):
+    client = dumputil.aws_client('dynamodb', profile, opts.get('endpoint_url'))
+    streams = dumputil.aws_client('dynamodbstreams', profile, opts.get('endpoint_url'))
+
+    description = client.describe_table(TableName=table)['Table']
+    spec = description.get('StreamSpecification') or {}
+    if not spec.get('StreamEnabled') or spec.get('StreamViewType') not in ('NEW_IMAGE', 'NEW_AND_OLD_IMAGES'):
+        raise ValueError(f'--sync requires a stream of NEW_IMAGE or NEW_AND_OLD_IMAGES on table {table}')
+    stream_arn = description['LatestStreamArn']
+    key_names = [k['AttributeName'] for k in description['KeySchema']]
+
+    def item_key(item):
+        return dumputil.encode_dynamodb_item({ k: item[k] for k in key_names }).decode('ascii')
+
+    store = dumputil.ItemStore(opts['sync'])
+    state = store.get_state('sync')
+    if state and state['table'] != table:
+        raise ValueError(f'{opts["sync"]} is a copy of table {state["table"]}, not {table}')
+    if state and state['stream_arn'] != stream_arn:
+        print(f'{bcolors.WARNING}the stream of {table} has changed; taking a new snapshot{bcolors.ENDC}', file=sys.stderr)
+        state = None
+    elif state and time.time() - state['synced'] > stream_retention:
+        print(f'{bcolors.WARNING}last synced more than 24 hours ago; taking a new snapshot{bcolors.ENDC}', file=sys.stderr)
+        state = None
+    if opts.get('snapshot'):
+        state = None
+
+    stop = threading.Event()
+    try:
+        if not state:
+            # The stream is read from its oldest record after the scan, so
+            # the time it was started is as good as any.
+            synced = time.time()
+            opts['request'] = {}
+            limiter = read_limiter(description, **opts)
+            store.clear()
+            def emit(segment, items, start_key):
+                store.put([(item_key(d), dumputil.encode_dynamodb_item(d).decode('ascii')) for d in items])
+            scan_segments(client, table, emit, stop, limiter, {}, **opts)
+            state = { 'table': table, 'stream_arn': stream_arn, 'synced': synced, 'positions': {} }
+            store.set_state('sync', state)
+            store.commit()
+            print(f'snapshot of {store.count()} items', file=sys.stderr)
+
+        synced = time.time()
+        positions = state['positions']
+        changes = collections.Counter()
+
+        def on_page(shard_id, records):
+            for r in records:
+                change = r['dynamodb']
+                if r['eventName'] == 'REMOVE':
+                    store.delete([item_key(change['Keys'])])
+                else:
+                    store.put([(item_key(change['Keys']), dumputil.encode_dynamodb_item(change['NewImage']).decode('ascii'))])
+                changes[r['eventName']] += 1
+            positions[shard_id] = { 'SequenceNumber': records[-1]['dynamodb']['SequenceNumber'] }
+            store.set_state('sync', state)
+            store.commit()
+
+        def on_finish(shard_id, closed):
+            if closed:
+                positions[shard_id] = { 'done': True }
+                store.set_state('sync', state)
+                store.commit()
+
+        shards = {}
+        def list_shards():
+            shards.update(list_stream_shards(streams, stream_arn))
+            return shards
+
+        dumputil.read_shard_tree(
+            list_shards,
+            lambda shard_id, emit: read_stream_shard(streams, stream_arn, shard_id, emit, stop, positions.get(shard_id),
+                                                     until=synced, **opts),
+            stop, on_page, on_finish=on_finish,
+            finished=[shard_id for shard_id, p in positions.items() if p.get('done')])
+
+        # Shards that have aged out of the stream will never be read again.
+        for shard_id in list(positions):
+            if shard_id not in shards:
+                del positions[shard_id]
+        state['synced'] = synced
+        store.set_state('sync', state)
+        store.commit()
+        print(f'applied {sum(changes.values())} changes ({", ".join(f"{n} {e}" for e, n in sorted(changes.items())) or "none"}); '
+              f'{store.count()} items', file=sys.stderr)
+    finally:
+        stop.set()
+        store.close()
+
+def list_stream_shards(streams, stream_arn):
+    r = streams.describe_stream(StreamArn=stream_arn)['StreamDescription']
+    shards = r['Shards']
+    while r.get('LastEvaluatedShardId'):
+        r = streams.describe_stream(StreamArn=stream_arn, ExclusiveStartShardId=r['LastEvaluatedShardId'])['StreamDescription']
+        shards += r['Shards']
+    if debug: print(f'{bcolors.GREY20}shards\n{pp.pformat(shards)}{bcolors.ENDC}', file=sys.stderr)
+    return { shard['ShardId']: shard for shard in shards }
+
+def read_stream_shard(streams, stream_arn, shard_id, emit, stop, position=None, until=None, **opts):
+    """Reads the changes in a shard of a DynamoDB Stream, passing each page to emit().
+
+    Returns True if the end of a closed shard was reached, and False once an
+    open shard has no more changes (or, with --follow, when stopped): after
+    stream_empty_pages empty pages in a row, or a change made at or after
+    the time `until`.
+    """
+    if position:
+        start = { 'ShardIteratorType': 'AFTER_SEQUENCE_NUMBER', 'SequenceNumber': position['SequenceNumber'] }
+    else:
+        start = { 'ShardIteratorType': 'TRIM_HORIZON' }
+    try:
+        itr = streams.get_shard_iterator(StreamArn=stream_arn, ShardId=shard_id, **start)['ShardIterator']
+    except streams.exceptions.TrimmedDataAccessException as e:
+        raise ValueError(f'changes in {shard_id} have been trimmed from the stream; sync with --snapshot') from e
+
+    calls = dumputil.RateLimiter(stream_read_calls * (opts.get('capacity_fraction') or 0.5))
+    empty_pages = 0
+    while not stop.is_set():
+        if not calls.acquire(stop=stop):
+            break
+        if debug: print(f'{bcolors.GREY20}{shard_id} fetch itr:{itr}{bcolors.ENDC}', file=sys.stderr)
+        try:
+            with metrics.timer('get_records') as m:
+                r = streams.get_records(ShardIterator=itr)
+                m['records'] = len(r['Records'])
+                m['bytes'] = dumputil.response_bytes(r)
+            calls.succeeded()
+        except streams.exceptions.LimitExceededException as e:
+            print(f'{bcolors.WARNING}caught {e}{bcolors.ENDC}', file=sys.stderr)
+            metrics.count('get_records', throttles=1)
+            stop.wait(calls.throttled())
+            continue
+        if r['Records']:
+            emit(shard_id, r['Records'])
+        itr = r.get('NextShardIterator')
+        if itr is None:
+            return True
+        if opts.get('follow'):
+            if not r['Records']:
+                stop.wait(1)
+        elif r['Records']:
+            empty_pages = 0
+            if until and r['Records'][-1]['dynamodb']['ApproximateCreationDateTime'].timestamp() >= until:
+                return False
+        else:
+            empty_pages += 1
+            if empty_pages >= stream_empty_pages:
+                return False
+    return False
+
 ########################################################################
 
 # https://stackoverflow.com/questions/1960516/python-json-serialize-a-decimal-object
@@ -128,10 +657,24 @@ def defaultencode(o):
     if isinstance(o, Decimal):
         # Subclass float with custom repr?
         return fakefloat(o)
+    if isinstance(o, (set, frozenset)):
+        return list(o)
+    if isinstance(o, dynamodb_types().Binary):
+        return base64.b64encode(o.value).decode('ascii')
     raise TypeError(repr(o) + " is not JSON serializable")
 
 # json.dumps([10.20, "10.20", Decimal('10.20')], default=defaultencode)
 
+# The values of binary key attributes are bytes, which can't be saved in a
+# JSON checkpoint as they are.
+def encode_key(key):
+    return { k: { 'B': base64.b64encode(v['B']).decode('ascii') } if 'B' in v else v
+             for k, v in key.items() }
+
+def decode_key(key):
+    return { k: { 'B': base64.b64decode(v['B']) } if 'B' in v else v
+             for k, v in key.items() }
+
 ########################################################################
 
 parser = argparse.ArgumentParser(description='Dump a DynamoDB table.')
@@ -139,16 +682,199 @@ parser.add_argument('table')
 parser.add_argument(
     '-p', '--profile', default=default_profile,
     help=f'specify AWS profile (default {default_profile})')
+parser.add_argument(
+    '--endpoint-url', metavar='URL',
+    help='send requests to URL instead of AWS, e.g. a local moto server')
 parser.add_argument(
     '-n', '--limit', type=int,
     help='stop fetching more records when limit is reached')
 parser.add_argument(
-    '-d', '--delay', type=int,
-    help='delay between calls to avoid exceeding provisioned throughput')
+    '-d', '--delay', type=float,
+    help='minimum delay in seconds between calls by each segment')
+parser.add_argument(
+    '--capacity-fraction', type=float, default=0.5,
+    help='fraction of the table\'s read capacity to use (default 0.5)')
+parser.add_argument(
+    '--read-capacity', type=float,
+    help='read capacity units per second to base --capacity-fraction on (default the provisioned capacity, or 3000 for on-demand tables)')
+parser.add_argument(
+    '-a', '--attributes',
+    help='comma-separated list of the attributes to fetch, e.g. "id,name,address.city,tags[0]"')
+parser.add_argument(
+    '--filter', metavar='EXPRESSION',
+    help='only return the items matching this FilterExpression, e.g. "#s = :s"')
+parser.add_argument(
+    '--names', type=json.loads,
+    help='ExpressionAttributeNames for --filter and --key-condition as a JSON object, e.g. \'{"#s": "status"}\'')
+parser.add_argument(
+    '--values', type=lambda s: json.loads(s, parse_float=Decimal),
+    help='ExpressionAttributeValues for --filter and --key-condition as a JSON object, e.g. \'{":s": "active"}\'')
+parser.add_argument(
+    '--index',
+    help='read this global or local secondary index instead of the table')
+query_group = parser.add_mutually_exclusive_group()
+query_group.add_argument(
+    '--query', metavar='VALUE',
+    help='query the partition whose partition key (of the table or --index) has this value instead of scanning')
+query_group.add_argument(
+    '--key-condition', metavar='EXPRESSION',
+    help='query the items matching this KeyConditionExpression instead of scanning')
+parser.add_argument(
+    '--segments', type=int,
+    help='split the scan into this many segments and scan them in parallel')
+parser.add_argument(
+    '--workers', type=int,
+    help='number of segments to scan concurrently (default the number of segments)')
+parser.add_argument(
+    '-f', '--format', choices=dumputil.sink_formats, default='ndjson',
+    help='output format (default ndjson)')
+parser.add_argument(
+    '-o', '--output', metavar='FILE',
+    help='write the output to FILE instead of stdout, or add the table to the SQLite file FILE for sqlite')
+parser.add_argument(
+    '--compress', choices=dumputil.sink_compressions,
+    help='compress ndjson output')
+parser.add_argument(
+    '--json-backend', choices=dumputil.json_backends, default='python',
+    help='library used to encode ndjson output (default python)')
+parser.add_argument(
+    '--decode-processes', type=int, metavar='N',
+    help='decode and encode pages in N worker processes instead of a thread; helps when one core can\'t keep up with the network')
+parser.add_argument(
+    '--sample', type=float, metavar='RATE',
+    help=f'scan a random fraction RATE of the table, e.g. 0.01, by scanning that fraction of its --segments (default {sample_segments})')
+parser.add_argument(
+    '--sample-size', type=int, metavar='N',
+    help='dump a uniform random sample of N of the items scanned; without --sample, scans enough of the table to expect a few times N items')
+parser.add_argument(
+    '--stats', action='store_true',
+    help='print the number of items read, a histogram of their sizes, and the presence, types and sizes of their attributes; the items are only written with --output')
+parser.add_argument(
+    '--sync', metavar='DB',
+    help='keep a copy of the table in the SQLite file DB up to date from the table\'s stream, scanning it only the first time; nothing is printed')
+parser.add_argument(
+    '--snapshot', action='store_true',
+    help='with --sync, scan the table again instead of applying changes to the copy')
+parser.add_argument(
+    '--follow', action='store_true',
+    help='with --sync, keep applying changes as they happen')
+parser.add_argument(
+    '--checkpoint', metavar='FILE',
+    help='save the progress of the dump to FILE every few pages')
+parser.add_argument(
+    '--resume', action='store_true',
+    help='continue the dump from the --checkpoint FILE of an interrupted one; append the output to that of the interrupted dump')
+parser.add_argument(
+    '--coordinate', metavar='LEASES',
+    help='share the --segments of the scan with the other workers run with the same SQLite file LEASES, on this host or others sharing its file system; each segment is dumped to a part file in the --output directory, and a manifest.json is written once all are done. Each worker reads at --capacity-fraction of the table\'s capacity, so divide it between them')
+parser.add_argument(
+    '--lease-ttl', type=float, default=60,
+    help='with --coordinate, seconds after which the segment of a worker that stops renewing its lease is taken over by another (default 60)')
+parser.add_argument(
+    '--progress', action='store_true',
+    help='print the number of items dumped, the rate, and an ETA every few seconds')
+parser.add_argument(
+    '--metrics', metavar='FILE',
+    help='write the latency, items, bytes, consumed capacity and throttles of the calls made to FILE at exit: in the Prometheus text format if FILE ends in .prom, as JSON otherwise')
 parser.add_argument(
     '--debug', action='store_true')
 args = parser.parse_args()
+if args.resume and not args.checkpoint:
+    parser.error('--resume requires --checkpoint')
+if (args.query is not None or args.key_condition) and args.segments:
+    parser.error('--segments only applies to scans')
+if args.sync and (args.attributes or args.filter or args.index or args.query is not None or args.key_condition or args.limit):
+    parser.error('--sync copies whole tables; it can\'t be combined with --attributes, --filter, --index, --query, --key-condition or --limit')
+if args.sync and (args.output or args.checkpoint):
+    parser.error('--sync writes to DB; it can\'t be combined with --output or --checkpoint')
+if (args.snapshot or args.follow) and not args.sync:
+    parser.error('--snapshot and --follow require --sync')
+if args.coordinate and not (args.segments and args.output):
+    parser.error('--coordinate requires --segments and an --output directory')
+if args.coordinate and (args.sync or args.limit or args.checkpoint or args.compress or args.format != 'ndjson'):
+    parser.error('--coordinate writes ndjson part files, checkpointing to LEASES; it can\'t be combined with --sync, --limit, --checkpoint, --compress or another --format')
+if (args.sample is not None or args.sample_size) and (args.query is not None or args.key_condition):
+    parser.error('--sample and --sample-size only apply to scans')
+if args.sample is not None and not 0 < args.sample <= 1:
+    parser.error('--sample RATE must be more than 0 and at most 1')
+if (args.sample is not None or args.sample_size or args.stats) and (args.sync or args.coordinate or args.checkpoint):
+    parser.error('--sample, --sample-size and --stats can\'t be combined with --sync, --coordinate or --checkpoint')
+if args.sample_size and args.limit:
+    parser.error('--sample-size can\'t be combined with --limit')
+if (args.sample is not None or args.sample_size) and not args.segments:
+    args.segments = sample_segments
+if args.sync and args.progress:
+    parser.error('--progress does not apply to --sync, which reports what it applied')
+try:
+    dumputil.check_optional(args.format, args.compress, args.json_backend)
+except ImportError as e:
+    parser.error(str(e))
 
 debug = args.debug
+metrics = dumputil.Metrics(tool='dynamodb-dump', table=args.table)
 
-dump_table(args.table, profile=args.profile, limit=args.limit)
+try:
+    if args.coordinate:
+        coordinate_table(
+            args.table,
+            profile=args.profile,
+            endpoint_url=args.endpoint_url,
+            delay=args.delay,
+            attributes=args.attributes,
+            filter=args.filter,
+            names=args.names,
+            values=args.values,
+            index=args.index,
+            capacity_fraction=args.capacity_fraction,
+            read_capacity=args.read_capacity,
+            segments=args.segments,
+            output=args.output,
+            json_backend=args.json_backend,
+            decode_processes=args.decode_processes,
+            coordinate=args.coordinate,
+            lease_ttl=args.lease_ttl,
+            progress=args.progress)
+    elif args.sync:
+        sync_table(
+            args.table,
+            profile=args.profile,
+            endpoint_url=args.endpoint_url,
+            sync=args.sync,
+            snapshot=args.snapshot,
+            follow=args.follow,
+            delay=args.delay,
+            capacity_fraction=args.capacity_fraction,
+            read_capacity=args.read_capacity,
+            segments=args.segments,
+            workers=args.workers)
+    else:
+        dump_table(
+            args.table,
+            profile=args.profile,
+            endpoint_url=args.endpoint_url,
+            limit=args.limit,
+            delay=args.delay,
+            attributes=args.attributes,
+            filter=args.filter,
+            names=args.names,
+            values=args.values,
+            index=args.index,
+            query=args.query,
+            key_condition=args.key_condition,
+            capacity_fraction=args.capacity_fraction,
+            read_capacity=args.read_capacity,
+            segments=args.segments,
+            workers=args.workers,
+            format=args.format,
+            output=args.output,
+            compress=args.compress,
+            json_backend=args.json_backend,
+            decode_processes=args.decode_processes,
+            checkpoint=args.checkpoint,
+            resume=args.resume,
+            sample=args.sample,
+            sample_size=args.sample_size,
+            stats=args.stats,
+            progress=args.progress)
+finally:
+    if args.metrics: metrics.write(args.metrics)
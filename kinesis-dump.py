@@ -2,29 +2,29 @@
 
 default_profile = 'fbot-sandbox'
 debug = False
-delay_sleep = 0.4 # seconds
+metrics = None
 
 import datetime
 import time
 
 import argparse
 import base64
+import collections
+import functools
+import itertools
 import json
+import math
 import os
-import pathlib
-import pprint
+import random
 import re
 import sys
+import threading
 
-pp = pprint.PrettyPrinter(indent=4, compact=True)
+# botocore and jmespath are imported when they're first used; see dumputil.
+# Run ./setup and activate venv3 to install them.
+import dumputil
 
-# Use awscli's virtualenv if we're not already running in one.
-if 'VIRTUAL_ENV' not in os.environ:
-    print('using awscli virtualenv', file=sys.stderr)
-    activate_script = pathlib.Path('/usr/local/bin/aws').resolve().parent.joinpath('activate_this.py')
-    exec(open(activate_script).read(), dict(__file__=activate_script))
-
-print(os.environ['VIRTUAL_ENV'], file=sys.stderr)
+pp = dumputil.LazyPrettyPrinter(indent=4, compact=True)
 
 def parse_since(since):
     """ Parses a "since" value and converts it to seconds."""
@@ -41,8 +41,10 @@ def parse_since(since):
         raise ValueError('since is not in format "INT[smhd]?"')
     return int(match.group(1)) * multiplier[match.group(2)]
 
-def handle_event(rec):
-    rec['Data'] = json.loads(base64.b64decode(rec['Data']))
+# Handlers unwrap the Data of the records of a stream whose records aren't
+# plain JSON, returning the JSON bytes.
+def handle_event(data):
+    return base64.b64decode(data)
 
 handler = {
     'fbt-event': handle_event,
@@ -67,32 +69,97 @@ class bcolors:
 # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/core/session.html
 # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/kinesis.html
 
-import botocore.session
-
-def dump_stream(stream, profile, **opts):
-    session = botocore.session.Session(profile=profile)
-    client = session.create_client('kinesis')
-
-    # A Kinesis stream may consist of one or more shards.  Each shard can
-    # handle 1 MB/S of writes, 2 MB/S of reads, or 1000 records per second.
-    # Records that are put onto the stream have a key that is hashed to
-    # determine which shard to send the record to.  Friendbuy does not use
-    # more than one shard for any of its Kinesis streams.
-
-    shards = client.list_shards(StreamName=stream)
-    if debug: print(f'{bcolors.GREY20}shards\n{pp.pformat(shards)}{bcolors.ENDC}', file=sys.stderr)
-    shard_count = len(shards['Shards'])
-    shard = opts.get('shard');
-    if shard_count > 1:
-        print(f'{bcolors.WARNING}shard count {shard_count} > 1; dumping {shard}{bcolors.ENDC}', file=sys.stderr)
-    shard_id = shards['Shards'][shard]['ShardId']
+# Each shard supports up to 5 GetRecords calls and 2 MB of reads per second,
+# shared by all of the stream's consumers.
+# https://docs.aws.amazon.com/streams/latest/dev/service-sizes-and-limits.html
+shard_read_calls = 5
+shard_read_bytes = 2 * 1024 * 1024
 
-    if opts.get('start', 0):
+def shard_start(shard_id, **opts):
+    """Returns the position to start reading a shard from, as get_shard_iterator() options."""
+    position = opts.get('positions', {}).get(shard_id)
+    if position:
+        return { 'ShardIteratorType': 'AFTER_SEQUENCE_NUMBER', 'StartingSequenceNumber': position['SequenceNumber'] }
+    elif opts.get('at_sequence'):
+        return { 'ShardIteratorType': 'AT_SEQUENCE_NUMBER', 'StartingSequenceNumber': opts['at_sequence'] }
+    elif opts.get('after_sequence'):
+        return { 'ShardIteratorType': 'AFTER_SEQUENCE_NUMBER', 'StartingSequenceNumber': opts['after_sequence'] }
+    elif opts.get('start', 0):
         # print(f'using start {opts["start"]}', file=sys.stderr)
-        shard_iterator_opts = { 'ShardIteratorType': 'AT_TIMESTAMP', 'Timestamp': opts['start'] }
+        return { 'ShardIteratorType': 'AT_TIMESTAMP', 'Timestamp': opts['start'] }
     else:
         # print('using trim_horizon', file=sys.stderr)
-        shard_iterator_opts = { 'ShardIteratorType': 'TRIM_HORIZON' }
+        return { 'ShardIteratorType': 'TRIM_HORIZON' }
+
+class Record:
+    """A record read from a shard, holding only what the dump uses.
+
+    Records are made from GetRecords and SubscribeToShard responses as soon
+    as they arrive, so the response dicts can be freed; records waiting in
+    the --order arrival merge or the pipeline take less memory than the
+    dicts, and pickle to --decode-processes as plain tuples.
+    """
+    __slots__ = ('sequence_number', 'arrival', 'data', 'partition_key', 'encryption_type')
+
+    def __init__(self, sequence_number, arrival, data, partition_key, encryption_type=None):
+        self.sequence_number = sequence_number
+        self.arrival = arrival
+        self.data = data
+        self.partition_key = partition_key
+        self.encryption_type = encryption_type
+
+    @classmethod
+    def from_kinesis(cls, d):
+        return cls(d['SequenceNumber'], d['ApproximateArrivalTimestamp'], d['Data'], d['PartitionKey'],
+                   d.get('EncryptionType'))
+
+    def __reduce__(self):
+        return Record, (self.sequence_number, self.arrival, self.data, self.partition_key, self.encryption_type)
+
+    def event(self, data):
+        """Returns the record as Kinesis does, with `data` as its Data, for --full-event."""
+        d = {
+            'SequenceNumber': self.sequence_number,
+            # Transform the arrival time back into a string.
+            'ApproximateArrivalTimestamp': self.arrival.astimezone(tz=datetime.timezone.utc).isoformat(),
+            'Data': data,
+            'PartitionKey': self.partition_key,
+        }
+        if self.encryption_type:
+            d['EncryptionType'] = self.encryption_type
+        return d
+
+def clip_to_end(records, watermark, **opts):
+    """Drops the records that arrived after the --end/--until time.
+
+    Returns the remaining records, and whether the shard has been read past
+    the end time, either because some records were dropped or because the
+    watermark shows that all later records will have arrived after it.
+    The watermark of a closed shard is measured against its own last
+    record, so callers check for the end of a closed shard first: its
+    children are still to be read.
+    """
+    end = opts.get('end')
+    if not end:
+        return records, False
+    kept = list(itertools.takewhile(lambda d: d.arrival <= end, records))
+    return kept, len(kept) < len(records) or watermark > end
+
+def read_shard(client, stream, shard_id, emit, stop, limiters=None, **opts):
+    """Reads a shard, passing each page of records to emit().
+
+    emit() is called as `emit(shard_id, records, watermark)`, where the
+    watermark is the arrival time that reading has caught up to: records
+    in later pages of the shard will have arrived after it.  Returns True if
+    the end of a closed shard (one that has been split or merged) was
+    reached, and False if reading stopped before that, e.g. at the end time.
+    `limiters` are the (calls, bytes) limiters of the shard if it's read
+    more than once.
+    """
+    if opts.get('consumer_arn'):
+        return subscribe_shard(client, shard_id, emit, stop, **opts)
+
+    shard_iterator_opts = shard_start(shard_id, **opts)
 
     r = client.get_shard_iterator(
         StreamName=stream,
@@ -103,117 +170,755 @@ def dump_stream(stream, profile, **opts):
 
     itr = r['ShardIterator']
 
-    more_data = True
+    # Aim for a fraction of the shard's read limits to leave room for the
+    # stream's other consumers.
+    calls, reads = limiters or shard_limiters(**opts)
+
     i = 0
-    n = 0
-    format = opts.get('format')
-    while more_data:
-        if debug: print(f'\n\n{bcolors.GREY20}fetch {i} itr:{itr}{bcolors.ENDC}', file=sys.stderr)
+    while not stop.is_set():
+        if debug: print(f'\n\n{bcolors.GREY20}{shard_id} fetch {i} itr:{itr}{bcolors.ENDC}', file=sys.stderr)
         while True:
+            if not calls.acquire(stop=stop) or not reads.acquire(0, stop):
+                return False
             try:
-                r = client.get_records(ShardIterator=itr)
+                with metrics.timer('get_records') as m:
+                    r = client.get_records(ShardIterator=itr)
+                    m['records'] = len(r['Records'])
+                    m['bytes'] = dumputil.response_bytes(r)
+                metrics.gauge('millis_behind_latest', r['MillisBehindLatest'], shard=shard_id)
                 if debug: print(pp.pformat(r), file=sys.stderr)
+                calls.succeeded()
+                reads.succeeded()
+                reads.consume(sum(len(d['Data']) for d in r['Records']))
                 break
             except client.exceptions.ProvisionedThroughputExceededException:
                 print("caught ProvisionedThroughputExceededException", file=sys.stderr)
-                time.sleep(delay_sleep)
-                pass
+                metrics.count('get_records', throttles=1)
+                reads.throttled()
+                stop.wait(calls.throttled())
             except Exception as e:
                 print(e, file=sys.stderr)
                 raise e
 
-        for d in r['Records']:
-            n += 1
-
-            d['Data'] = d['Data'].decode('utf-8')
-            d['Data'] = json.loads(d['Data'])
+        watermark = datetime.datetime.now(tz=datetime.timezone.utc) - \
+            datetime.timedelta(milliseconds=r['MillisBehindLatest'])
+        records, ended = clip_to_end([Record.from_kinesis(d) for d in r['Records']], watermark, **opts)
+        emit(shard_id, records, watermark)
 
-            if stream in handler:
-                d = handler[stream](d)
-            # if format != 'python':
-            #     d['Data'] = json.loads(d['Data'])
-            if opts.get('full_event'):
-                # The Kinesis has decoded this into a datetime object; transform it back into a string.
-                d['ApproximateArrivalTimestamp'] = \
-                    d['ApproximateArrivalTimestamp'].astimezone(tz=datetime.timezone.utc).isoformat()
-            else:
-                d = d['Data']
-
-            print(f'\n{bcolors.GREY10}record {n}:{bcolors.ENDC}', file=sys.stderr)
-            if format == 'python':
-                pp.pprint(d)
-            elif format == 'json':
-                print(json.dumps(d, indent=2))
-                # sys.stdout.buffer.write(json.dumps(d))
-                # sys.stdout.buffer.write(b'\n')
-                # sys.stdout.buffer.flush()
-            else:
-                raise Exception(f'unknown format ${format}')
-        itr = r['NextShardIterator']
-        if args.limit and n >= args.limit:
-            more_data = False
-        elif itr == None:
-            more_data = False
+        itr = r.get('NextShardIterator')
+        if itr == None:
+            # A closed shard that has been read to its end isn't behind.
+            metrics.gauge('millis_behind_latest', 0, shard=shard_id)
+            return True
+        elif ended:
+            return False
         elif r['MillisBehindLatest'] == 0:
-            if args.follow:
-                time.sleep(5)
+            if opts.get('follow'):
+                stop.wait(5)
             else:
-                more_data = False
-        else:
-            # Sleep to avoid exceeding 5-calls-per-second limit.  This
-            # rate-limit is applied across all consumers, and clients will
-            # receive ProvisionedThroughputExceededException if it is
-            # exceeded.
-            time.sleep(delay_sleep)
+                return False
         i += 1
+    return False
+
+def shard_limiters(**opts):
+    fraction = opts.get('capacity_fraction') or 0.5
+    return dumputil.RateLimiter(shard_read_calls * fraction), dumputil.RateLimiter(shard_read_bytes * fraction)
+
+# --sample reads a random fraction of the time in each shard: records can't
+# be skipped within a shard, but reading can start at any time.
+sample_slice = 60 # seconds, at most
+
+def sample_slices(client, stream, **opts):
+    """Picks the slices of time to read from each shard for --sample.
+
+    The window from the start time, or the oldest record the stream keeps,
+    to the end time, or now, is cut into slices of at most a minute, and at
+    least a hundred of them, and a random --sample fraction of them is
+    picked for each shard.  Returns { shard_id: [(start, end), ...] } and
+    the fraction of the window that will be read.
+    """
+    now = datetime.datetime.now().astimezone()
+    if opts.get('start'):
+        start = opts['start'].astimezone()
+    else:
+        hours = client.describe_stream_summary(StreamName=stream)['StreamDescriptionSummary']['RetentionPeriodHours']
+        start = now - datetime.timedelta(hours=hours)
+    end = opts.get('end') or now
+    window = (end - start).total_seconds()
+    length = min(sample_slice, window / 100)
+    count = math.ceil(window / length)
+    picked = max(1, round(opts['sample'] * count))
+
+    def time_slice(i):
+        return start + datetime.timedelta(seconds=i * length), min(end, start + datetime.timedelta(seconds=(i + 1) * length))
+
+    slices = { shard_id: [time_slice(i) for i in sorted(random.sample(range(count), picked))]
+               for shard_id in list_all_shards(client, stream, **{ **opts, 'start': start }) }
+    if debug: print(f'{bcolors.GREY20}reading {picked} of {count} slices of {length:.1f}s of each shard{bcolors.ENDC}', file=sys.stderr)
+    return slices, picked / count
+
+def read_slices(client, stream, write, stop, **opts):
+    """Reads the opts['slices'] of each shard, the shards concurrently."""
+    def read_shard_slices(shard_id):
+        limiters = shard_limiters(**opts)
+        for start, end in opts['slices'][shard_id]:
+            # Getting the shard iterator counts against the same limit.
+            if not limiters[0].acquire(stop=stop):
+                return
+            read_shard(client, stream, shard_id, lambda shard_id, records, watermark: write(shard_id, records), stop,
+                       limiters, **{ **opts, 'start': start, 'end': end })
+
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(opts['slices']))) as pool:
+        futures = [pool.submit(read_shard_slices, shard_id) for shard_id in opts['slices']]
+        try:
+            for f in futures:
+                f.result()
+        except BaseException:
+            stop.set()
+            raise
+
+# Enhanced fan-out: instead of polling GetRecords, which shares each shard's
+# 5 calls/s and 2 MB/s with all other polling consumers, a registered
+# consumer gets records pushed to it over SubscribeToShard with 2 MB/s of
+# its own, as soon as they arrive.  A subscription lasts 5 minutes and is
+# then renewed from where it ended.
+# https://docs.aws.amazon.com/streams/latest/dev/enhanced-consumers.html
+
+def register_consumer(client, stream, name):
+    """Registers (or finds) the consumer `name` and waits for it to become active.
+
+    Returns its ARN, and whether it was registered here and so should be
+    deregistered when we're done with it.
+    """
+    stream_arn = client.describe_stream_summary(StreamName=stream)['StreamDescriptionSummary']['StreamARN']
+    try:
+        r = client.register_stream_consumer(StreamARN=stream_arn, ConsumerName=name)
+        registered = True
+    except client.exceptions.ResourceInUseException:
+        r = client.describe_stream_consumer(StreamARN=stream_arn, ConsumerName=name)
+        registered = False
+    consumer = r.get('Consumer') or r['ConsumerDescription']
+    while consumer['ConsumerStatus'] != 'ACTIVE':
+        if debug: print(f'{bcolors.GREY20}consumer {name} is {consumer["ConsumerStatus"]}{bcolors.ENDC}', file=sys.stderr)
+        time.sleep(1)
+        consumer = client.describe_stream_consumer(ConsumerARN=consumer['ConsumerARN'])['ConsumerDescription']
+    if debug: print(f'{bcolors.GREY20}consumer\n{pp.pformat(consumer)}{bcolors.ENDC}', file=sys.stderr)
+    return consumer['ConsumerARN'], registered
+
+def subscribe_shard(client, shard_id, emit, stop, **opts):
+    """Reads a shard through enhanced fan-out; see read_shard()."""
+    start = shard_start(shard_id, **opts)
+    position = { 'Type': start['ShardIteratorType'] }
+    if 'StartingSequenceNumber' in start: position['SequenceNumber'] = start['StartingSequenceNumber']
+    if 'Timestamp' in start: position['Timestamp'] = start['Timestamp']
+
+    failures = 0
+    while not stop.is_set():
+        if debug: print(f'{bcolors.GREY20}{shard_id} subscribe {position}{bcolors.ENDC}', file=sys.stderr)
+        try:
+            r = client.subscribe_to_shard(
+                ConsumerARN=opts['consumer_arn'], ShardId=shard_id, StartingPosition=position)
+        except (client.exceptions.ResourceInUseException, client.exceptions.LimitExceededException) as e:
+            # The previous subscription to the shard hasn't ended yet, or we
+            # resubscribed too soon (only one call per second is allowed).
+            print(f'{bcolors.WARNING}caught {e}{bcolors.ENDC}', file=sys.stderr)
+            failures += 1
+            stop.wait(min(5, 0.5 * 2 ** failures))
+            continue
+        failures = 0
+
+        events = r['EventStream']
+        try:
+            for event in events:
+                e = event['SubscribeToShardEvent']
+                if debug: print(pp.pformat(e), file=sys.stderr)
+                metrics.count('subscribe_to_shard', events=1, records=len(e['Records']),
+                              bytes=sum(len(d['Data']) for d in e['Records']))
+                metrics.gauge('millis_behind_latest', e['MillisBehindLatest'], shard=shard_id)
+                watermark = datetime.datetime.now(tz=datetime.timezone.utc) - \
+                    datetime.timedelta(milliseconds=e['MillisBehindLatest'])
+                records, ended = clip_to_end([Record.from_kinesis(d) for d in e['Records']], watermark, **opts)
+                emit(shard_id, records, watermark)
+
+                if e.get('ContinuationSequenceNumber') is None:
+                    metrics.gauge('millis_behind_latest', 0, shard=shard_id)
+                    return True
+                elif ended:
+                    return False
+                position = { 'Type': 'AFTER_SEQUENCE_NUMBER', 'SequenceNumber': e['ContinuationSequenceNumber'] }
+                if stop.is_set() or (e['MillisBehindLatest'] == 0 and not opts.get('follow')):
+                    return False
+        finally:
+            events.close()
+    return False
+
+def list_all_shards(client, stream, **opts):
+    # Skip the shards that were closed before the start time: they have
+    # nothing to read.
+    shard_filter = {}
+    if opts.get('start'):
+        shard_filter['ShardFilter'] = { 'Type': 'FROM_TIMESTAMP', 'Timestamp': opts['start'] }
+    r = client.list_shards(StreamName=stream, **shard_filter)
+    shards = r['Shards']
+    while r.get('NextToken'):
+        r = client.list_shards(NextToken=r['NextToken'])
+        shards += r['Shards']
+    if debug: print(f'{bcolors.GREY20}shards\n{pp.pformat(shards)}{bcolors.ENDC}', file=sys.stderr)
+    return { shard['ShardId']: shard for shard in shards }
+
+class ArrivalMerge:
+    """Merges pages of records from several shards by ApproximateArrivalTimestamp.
+
+    A buffered record is released once no unfinished shard can still produce
+    an earlier one, i.e. every other unfinished shard either has a record
+    buffered or has reported a watermark past it.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        self.watermarks = {}
+
+    def add_shard(self, shard_id):
+        self.buffers[shard_id] = collections.deque()
+        self.watermarks[shard_id] = None
+
+    def add(self, shard_id, records, watermark):
+        self.buffers[shard_id].extend(records)
+        self.watermarks[shard_id] = watermark
+
+    def finish(self, shard_id):
+        del self.watermarks[shard_id]
+
+    def pop_ready(self, drain=False):
+        """Returns the (shard_id, record) pairs that are ready to be written."""
+        ready = []
+        while True:
+            pending = [(b[0].arrival, shard_id)
+                       for shard_id, b in self.buffers.items() if b]
+            if not pending:
+                break
+            ts, shard_id = min(pending)
+            if not drain and any(not self.buffers[other] and (watermark is None or watermark < ts)
+                                 for other, watermark in self.watermarks.items()):
+                break
+            ready.append((shard_id, self.buffers[shard_id].popleft()))
+        return ready
+
+def read_all_shards(client, stream, write, stop, **opts):
+    # With --order arrival, pages are merged before they're written.
+    merge = ArrivalMerge() if opts.get('order') == 'arrival' else None
+
+    def on_page(shard_id, records, watermark):
+        if merge:
+            merge.add(shard_id, records, watermark)
+            write_merged(write, merge.pop_ready())
+        else:
+            write(shard_id, records)
+
+    def on_finish(shard_id, closed):
+        if debug: print(f'{bcolors.GREY20}done reading {shard_id}{bcolors.ENDC}', file=sys.stderr)
+        if merge:
+            merge.finish(shard_id)
+            write_merged(write, merge.pop_ready())
+
+    dumputil.read_shard_tree(
+        lambda: list_all_shards(client, stream, **opts),
+        lambda shard_id, emit: read_shard(client, stream, shard_id, emit, stop, **opts),
+        stop, on_page, on_shard=merge and merge.add_shard, on_finish=on_finish)
+    if merge: write_merged(write, merge.pop_ready(drain=True))
+
+def write_merged(write, ready):
+    for shard_id, group in itertools.groupby(ready, key=lambda pair: pair[0]):
+        write(shard_id, [d for _, d in group])
+
+def decode_records(records, unwrap, encode, **opts):
+    """Decodes, filters and formats a page of records.
+
+    Records are first checked against the --partition-key and --grep
+    pre-filters, which need no JSON decoding, then decoded and formatted,
+    and then checked against --where and projected with --select.  Returns
+    the sequence numbers of the records that were kept and the records,
+    encoded as JSON lines for ndjson output.
+    """
+    partition_keys = opts.get('partition_keys')
+    grep = opts.get('grep')
+    import jmespath
+    where = opts.get('where') and jmespath.compile(opts['where'])
+    select = opts.get('select') and jmespath.compile(opts['select'])
+
+    sequence_numbers = []
+    kept = []
+    full_event = opts.get('full_event')
+    for record in records:
+        if partition_keys and record.partition_key not in partition_keys:
+            continue
+        data = unwrap(record.data) if unwrap else record.data
+        if grep and grep not in data:
+            continue
+        d = json.loads(data)
+        if full_event:
+            d = record.event(d)
+        if where and not jmespath_true(where.search(d)):
+            continue
+        if select:
+            d = select.search(d)
+        sequence_numbers.append(record.sequence_number)
+        kept.append(d)
+    return sequence_numbers, dumputil.json_lines(kept) if encode else kept
+
+def jmespath_true(v):
+    # https://jmespath.org/specification.html#or-expressions
+    return not (v is None or v is False or v == '' or v == [] or v == {})
+
+def jmespath_expression(expression):
+    # Only checks the expression; it's compiled again where it's used, which
+    # may be in another process.
+    import jmespath
+    jmespath.compile(expression)
+    return expression
+
+def print_record(d, n, **opts):
+    format = opts.get('format')
+    print(f'\n{bcolors.GREY10}record {n}:{bcolors.ENDC}', file=sys.stderr)
+    if format == 'python':
+        pp.pprint(d)
+    elif format == 'json':
+        print(json.dumps(d, indent=2))
+        # sys.stdout.buffer.write(json.dumps(d))
+        # sys.stdout.buffer.write(b'\n')
+        # sys.stdout.buffer.flush()
+    else:
+        raise Exception(f'unknown format ${format}')
+
+def dump_stream(stream, profile, **opts):
+    client = dumputil.aws_client('kinesis', profile, opts.get('endpoint_url'))
+
+    limit = opts.get('limit')
+    filtered = any(opts.get(o) for o in ('partition_keys', 'grep', 'where'))
+
+    # Set once the limit has been reached so that the shard readers stop.
+    stop = threading.Event()
+
+    # The checkpoint records the sequence number of the last record written
+    # from each shard.  Shards are resumed after that record; shards without
+    # a position are read from the start position as usual.
+    # The python and json formats are for reading; the others go to a sink,
+    # which writes whole pages of records at once.
+    sink = None
+    if opts.get('format') in dumputil.sink_formats:
+        sink = dumputil.open_sink(
+            opts.get('output'), opts['format'], opts.get('compress'), append=opts.get('resume'),
+            table=stream, columns=['SequenceNumber', 'PartitionKey', 'ApproximateArrivalTimestamp'])
+
+    # A worker of a coordinated dump checkpoints to the lease on the shard
+    # it holds instead.
+    checkpoint = None
+    if opts.get('lease'):
+        checkpoint = opts['lease']
+        checkpoint.flush = sink.flush
+        opts['positions'] = dict(checkpoint.positions)
+    elif opts.get('checkpoint'):
+        checkpoint = dumputil.Checkpoint(opts['checkpoint'], sink and sink.flush, stream=stream)
+        if opts.get('resume'):
+            if not checkpoint.load():
+                print(f'{bcolors.WARNING}no checkpoint {opts["checkpoint"]}; starting from the beginning{bcolors.ENDC}', file=sys.stderr)
+            opts['positions'] = dict(checkpoint.positions)
+
+    # --stats summarizes the records as they are decoded, and only writes
+    # them with --output.  --sample-size holds on to a sample of them until
+    # reading is done.
+    stats = dumputil.Stats() if opts.get('stats') else None
+    writing = not stats or opts.get('output')
+    reservoir = dumputil.Reservoir(opts['sample_size']) if opts.get('sample_size') else None
+    encode = opts.get('format') == 'ndjson' and not stats
+    sample_fraction = None
+    if opts.get('sample'):
+        opts['slices'], sample_fraction = sample_slices(client, stream, **opts)
+
+    def output(records, written):
+        if sink and encode:
+            sink.write_encoded(records)
+        elif sink:
+            sink.write(records)
+        else:
+            for i, d in enumerate(records):
+                print_record(d, written + i + 1, **opts)
+        metrics.count('write', records=len(records))
+
+    # Pages are decoded and written by a pipeline, so that the shards are
+    # read while the last pages are being decoded.
+    written = 0
+    def write(decoded, shard_id, sequence_number):
+        nonlocal written
+        sequence_numbers, records = decoded
+        if limit and len(records) >= limit - written:
+            # Resume after the last record that was written rather than
+            # after the whole page.
+            records = records[:limit - written]
+            if records: sequence_number = sequence_numbers[len(records) - 1]
+            stop.set()
+        if stats:
+            for d in records:
+                stats.add(*dumputil.json_record_stats(d))
+        if reservoir:
+            reservoir.extend(records)
+        elif writing:
+            output(records, written)
+        written += len(records)
+        if checkpoint and (records or not limit or written < limit):
+            checkpoint.set_position(shard_id, { 'SequenceNumber': sequence_number })
+            checkpoint.page_written()
+
+    pipeline = dumputil.Pipeline(
+        functools.partial(decode_records, unwrap=handler.get(stream), encode=encode,
+                          full_event=opts.get('full_event'), partition_keys=opts.get('partition_keys'),
+                          grep=opts.get('grep'), where=opts.get('where'), select=opts.get('select')),
+        write, opts.get('decode_processes'), metrics=metrics, pool=opts.get('pool'))
+
+    # Kinesis delivers records at least once, e.g. again after a fan-out
+    # subscription is renewed.  Sequence numbers increase within a shard, so
+    # the last one emitted from each shard is all it takes to drop records
+    # that have been seen before, however long the dump runs.
+    last_sequence = {}
+    def new_records(shard_id, records):
+        last = last_sequence.get(shard_id)
+        if last is not None and records and int(records[0].sequence_number) <= last:
+            kept = [d for d in records if int(d.sequence_number) > last]
+            metrics.count('write', duplicates=len(records) - len(kept))
+            records = kept
+        if records:
+            last_sequence[shard_id] = int(records[-1].sequence_number)
+        return records
+
+    # Without filters every record read is written, so the limit can be
+    # applied before the records are decoded.
+    n = 0
+    def emit(shard_id, records):
+        nonlocal n
+        records = new_records(shard_id, records)
+        if limit and not filtered: records = records[:limit - n]
+        if not records:
+            return
+        pipeline.put(records, shard_id, records[-1].sequence_number)
+        n += len(records)
+        if limit and not filtered and n >= limit:
+            stop.set()
+
+    progress = None
+    if opts.get('progress'):
+        progress = dumputil.Progress(progress_line())
+
+    consumer_arn = None
+    registered = False
+    try:
+        if opts.get('fan_out'):
+            consumer_arn, registered = register_consumer(client, stream, opts['fan_out'])
+        try:
+            read_shards(client, stream, emit, stop, consumer_arn=consumer_arn, **opts)
+        finally:
+            pipeline.close()
+        if reservoir and writing:
+            output(reservoir.items, 0)
+    finally:
+        try:
+            if checkpoint: checkpoint.save()
+        finally:
+            if sink: sink.close()
+            if registered:
+                if debug: print(f'{bcolors.GREY20}deregistering consumer {consumer_arn}{bcolors.ENDC}', file=sys.stderr)
+                client.deregister_stream_consumer(ConsumerARN=consumer_arn)
+            if progress: progress.close()
+    if stats:
+        stats.print(total=sample_fraction and stats.count / sample_fraction)
+
+def coordinate_stream(stream, profile, **opts):
+    """Dumps the shards of a stream that the workers sharing opts['coordinate'] haven't.
+
+    Each shard is dumped to its own part file in the output directory, which
+    gets a manifest.json listing them once every shard is done.
+    """
+    directory = opts['output']
+    os.makedirs(directory, exist_ok=True)
+    # The pool of --decode-processes is shared by the parts, and forked
+    # before the leases' renewal thread starts.
+    pool = None
+    if opts.get('decode_processes'):
+        opts['pool'] = pool = dumputil.decode_pool(opts['decode_processes'])
+    leases = dumputil.Leases(opts['coordinate'], opts.get('lease_ttl') or 60, stream=stream)
+    try:
+        # Workers started at different times must read the same records, so
+        # the first one decides the start and end times, e.g. of --since.
+        window = leases.setdefault('window', { t: opts[t] and opts[t].isoformat() for t in ('start', 'end') })
+        opts.update({ t: window[t] and datetime.datetime.fromisoformat(window[t]) for t in ('start', 'end') })
+
+        client = dumputil.aws_client('kinesis', profile, opts.get('endpoint_url'))
+        leases.add(list_all_shards(client, stream, **opts))
+
+        def part_path(shard_id):
+            return os.path.join(directory, f'part-{shard_id}.ndjson')
+
+        def dump_part(shard_id, path, lease, append):
+            print(f'{bcolors.GREY20}dumping {shard_id} to {path}{bcolors.ENDC}', file=sys.stderr)
+            dump_stream(stream, profile, **{ **opts, 'leased_shard': shard_id, 'output': path, 'resume': append, 'lease': lease })
+
+        dumputil.work_leases(leases, dump_part, part_path)
+        leases.write_manifest(os.path.join(directory, 'manifest.json'))
+    finally:
+        leases.close()
+        if pool:
+            pool.close()
+            pool.join()
+
+def progress_line():
+    """Returns a function describing how far the dump has got, for --progress.
+
+    How far behind the stream's latest record reading is comes from the
+    shards' MillisBehindLatest; the ETA is how long it will take to catch up
+    at the rate that has been falling since the last progress line.
+    """
+    last = None
+    def line():
+        nonlocal last
+        elapsed = metrics.elapsed()
+        written = metrics.get('write', 'records')
+        line = f'{written} records ({written / elapsed:.0f}/s)'
+        behind = metrics.gauge_values('millis_behind_latest')
+        if behind:
+            behind = max(behind) / 1000
+            eta = None
+            if behind == 0:
+                eta = 0
+            elif last and last[1] > behind:
+                eta = behind * (elapsed - last[0]) / (last[1] - behind)
+            last = (elapsed, behind)
+            line += f', {dumputil.format_duration(behind)} behind, ETA {dumputil.format_duration(eta)}'
+        throttles = metrics.get('get_records', 'throttles')
+        if throttles:
+            line += f', {throttles} throttled'
+        return f'{bcolors.GREY20}{line}{bcolors.ENDC}'
+    return line
+
+def read_shards(client, stream, write, stop, **opts):
+    # A Kinesis stream may consist of one or more shards.  Each shard can
+    # handle 1 MB/S of writes, 2 MB/S of reads, or 1000 records per second.
+    # Records that are put onto the stream have a key that is hashed to
+    # determine which shard to send the record to.  Friendbuy does not use
+    # more than one shard for any of its Kinesis streams.
+
+    if opts.get('slices'):
+        read_slices(client, stream, write, stop, **opts)
+        return
+    if opts.get('all_shards'):
+        read_all_shards(client, stream, write, stop, **opts)
+        return
+    if opts.get('leased_shard'):
+        read_shard(client, stream, opts['leased_shard'], lambda shard_id, records, watermark: write(shard_id, records), stop, **opts)
+        return
+
+    shards = client.list_shards(StreamName=stream)
+    if debug: print(f'{bcolors.GREY20}shards\n{pp.pformat(shards)}{bcolors.ENDC}', file=sys.stderr)
+    shard_count = len(shards['Shards'])
+    shard = opts.get('shard');
+    if shard_count > 1:
+        print(f'{bcolors.WARNING}shard count {shard_count} > 1; dumping {shard} (use --all-shards to dump all of them){bcolors.ENDC}', file=sys.stderr)
+    shard_id = shards['Shards'][shard]['ShardId']
+
+    read_shard(client, stream, shard_id, lambda shard_id, records, watermark: write(shard_id, records), stop, **opts)
 
 ########################################################################
 
 parser = argparse.ArgumentParser(description='Dump a Kinesis stream.')
 parser.add_argument('stream')
 parser.add_argument(
-    '-f', '--format', choices=['json', 'python'], default='python',
+    '-f', '--format', choices=['json', 'python'] + dumputil.sink_formats, default='python',
     help=f'output format (default python)')
+parser.add_argument(
+    '-o', '--output', metavar='FILE',
+    help='write ndjson, parquet, or arrow output to FILE instead of stdout, or add the records to the SQLite file FILE for sqlite')
+parser.add_argument(
+    '--compress', choices=dumputil.sink_compressions,
+    help='compress ndjson output')
 parser.add_argument(
     '-p', '--profile', default=default_profile,
     help=f'specify AWS profile (default {default_profile})')
+parser.add_argument(
+    '--endpoint-url', metavar='URL',
+    help='send requests to URL instead of AWS, e.g. a local moto server')
 parser.add_argument(
     '--follow', action='store_true',
     help='continue waiting for more data when the end of the stream is reached')
-parser.add_argument(
+shard_group = parser.add_mutually_exclusive_group()
+shard_group.add_argument(
     '--shard', type=int, default=0,
     help='select the shard to dump')
+shard_group.add_argument(
+    '--all-shards', action='store_true',
+    help='dump all shards concurrently, following splits and merges')
+parser.add_argument(
+    '--fan-out', metavar='CONSUMER', nargs='?', const=f'kinesis-dump-{os.uname().nodename}-{os.getpid()}',
+    help='read through an enhanced fan-out consumer, registered for the dump and deregistered afterwards unless it already existed; records are pushed as they arrive instead of being polled')
+parser.add_argument(
+    '--order', choices=['interleave', 'arrival'], default='interleave',
+    help='with --all-shards, print records as they are read (interleave) or in ApproximateArrivalTimestamp order (arrival) (default interleave)')
 parser.add_argument(
     '-n', '--limit', type=int,
     help='stop fetching more records when limit is reached')
-time_group = parser.add_mutually_exclusive_group()
-time_group.add_argument(
+start_group = parser.add_mutually_exclusive_group()
+start_group.add_argument(
     '--start', type=datetime.datetime.fromisoformat,
     help='time to start fetching data from in ISO format (YYYY-MM-DD[THH[:MM[:SS]]])')
-time_group.add_argument(
+start_group.add_argument(
     '--since', type=parse_since,
     help='number of seconds in the past to start fetching data from, with optional suffix m:minutes, h:hours, d:days')
+start_group.add_argument(
+    '--at-sequence', metavar='SEQUENCE_NUMBER',
+    help='start fetching data from the record with this sequence number in the selected --shard')
+start_group.add_argument(
+    '--after-sequence', metavar='SEQUENCE_NUMBER',
+    help='start fetching data after the record with this sequence number in the selected --shard')
+end_group = parser.add_mutually_exclusive_group()
+end_group.add_argument(
+    '--end', type=datetime.datetime.fromisoformat,
+    help='stop reading each shard at the first record that arrived after this time, in ISO format (YYYY-MM-DD[THH[:MM[:SS]]])')
+end_group.add_argument(
+    '--until', type=parse_since,
+    help='number of seconds in the past to stop fetching data at, with optional suffix m:minutes, h:hours, d:days')
+parser.add_argument(
+    '--partition-key', action='append', metavar='KEY', dest='partition_keys',
+    help='only dump records with this partition key; may be repeated')
+parser.add_argument(
+    '--grep', metavar='TEXT',
+    help='only dump records whose raw JSON contains TEXT, e.g. \'"merchantId":"m123"\'; checked before the JSON is decoded')
+parser.add_argument(
+    '--where', type=jmespath_expression, metavar='EXPRESSION',
+    help='only dump records for which this JMESPath expression is true, e.g. "merchantId == \'m123\' && amount > `100`"; applies to the Data, or the whole record with --full-event')
+parser.add_argument(
+    '--select', type=jmespath_expression, metavar='EXPRESSION',
+    help='dump the result of this JMESPath expression instead of the record, e.g. "{id: id, merchant: merchantId}"; parquet and arrow need an object')
+parser.add_argument(
+    '--sample', type=float, metavar='RATE',
+    help='read a random fraction RATE, e.g. 0.01, of the time from the start time (or the oldest record) to the end time (or now) in every shard, in slices of up to a minute')
+parser.add_argument(
+    '--sample-size', type=int, metavar='N',
+    help='dump a uniform random sample of N of the records read')
+parser.add_argument(
+    '--stats', action='store_true',
+    help='print the number of records read, a histogram of their sizes, and the presence, types and sizes of their attributes; the records are only written with --output')
+parser.add_argument(
+    '--capacity-fraction', type=float, default=0.5,
+    help='fraction of the shard\'s read limits (5 calls/s, 2 MB/s) to use (default 0.5)')
+parser.add_argument(
+    '--decode-processes', type=int, metavar='N',
+    help='decode and encode pages in N worker processes instead of a thread; helps when one core can\'t keep up with the network')
+parser.add_argument(
+    '--checkpoint', metavar='FILE',
+    help='save the position in each shard to FILE every few pages')
+parser.add_argument(
+    '--resume', action='store_true',
+    help='continue the dump from the --checkpoint FILE of an interrupted one; append the output to that of the interrupted dump')
+parser.add_argument(
+    '--coordinate', metavar='LEASES',
+    help='share the shards of the stream with the other workers run with the same SQLite file LEASES, on this host or others sharing its file system; each shard is dumped to a part file in the --output directory, and a manifest.json is written once all are done')
+parser.add_argument(
+    '--lease-ttl', type=float, default=60,
+    help='with --coordinate, seconds after which the shard of a worker that stops renewing its lease is taken over by another (default 60)')
+parser.add_argument(
+    '--progress', action='store_true',
+    help='print the number of records dumped, the rate, how far behind the latest record reading is, and an ETA every few seconds')
+parser.add_argument(
+    '--metrics', metavar='FILE',
+    help='write the latency, records, bytes and throttles of the calls made to FILE at exit: in the Prometheus text format if FILE ends in .prom, as JSON otherwise')
 parser.add_argument(
     '--debug', action='store_true')
 parser.add_argument(
     '--full-event', action='store_true',
     help='print the full event including the ApproximateArrivalTimestamp, PartitionKey, and SequenceNumber; otherwise prints the Data only')
 args = parser.parse_args()
+if args.resume and not args.checkpoint:
+    parser.error('--resume requires --checkpoint')
+if args.coordinate and not args.output:
+    parser.error('--coordinate requires an --output directory')
+if args.coordinate and args.format == 'python':
+    # The default format is for reading; the parts are ndjson.
+    args.format = 'ndjson'
+if args.coordinate and (args.follow or args.limit or args.checkpoint or args.compress or args.format != 'ndjson'
+                        or args.all_shards or args.at_sequence or args.after_sequence):
+    parser.error('--coordinate dumps every shard to an ndjson part file, checkpointing to LEASES; it can\'t be combined with --follow, --limit, --checkpoint, --compress, another --format, --all-shards, --at-sequence or --after-sequence')
+if args.sample is not None and not 0 < args.sample <= 1:
+    parser.error('--sample RATE must be more than 0 and at most 1')
+if (args.sample is not None or args.sample_size or args.stats) and (args.follow or args.checkpoint or args.coordinate):
+    parser.error('--sample, --sample-size and --stats can\'t be combined with --follow, --checkpoint or --coordinate')
+if args.sample is not None and (args.fan_out or args.at_sequence or args.after_sequence):
+    parser.error('--sample reads every shard from random times; it can\'t be combined with --fan-out, --at-sequence or --after-sequence')
+if args.sample_size and args.limit:
+    parser.error('--sample-size can\'t be combined with --limit')
+if (args.output or args.compress) and args.format not in dumputil.sink_formats:
+    parser.error(f'--output and --compress require --format {"|".join(dumputil.sink_formats)}')
+if args.format == 'sqlite':
+    if args.select:
+        parser.error('--select does not apply to --format sqlite, which stores whole records')
+    # The record's metadata is indexed.
+    args.full_event = True
+if (args.at_sequence or args.after_sequence) and args.all_shards:
+    parser.error('--at-sequence and --after-sequence apply to a single --shard; sequence numbers are per shard')
+try:
+    dumputil.check_optional(args.format, args.compress)
+except ImportError as e:
+    parser.error(str(e))
 
 debug = args.debug
+metrics = dumputil.Metrics(tool='kinesis-dump', stream=args.stream)
 
+# Times without a timezone are local.  They're made timezone-aware, as
+# botocore sends naive datetimes as UTC, and the end time is compared with
+# the records' ApproximateArrivalTimestamps, which are timezone-aware.
 start=None
 if args.start:
-    start = args.start
+    start = args.start.astimezone()
 elif args.since:
-    start = datetime.datetime.fromtimestamp(time.time() - args.since)
-
-dump_stream(
-    args.stream,
-    profile=args.profile,
-    follow=args.follow,
-    shard=args.shard,
-    limit=args.limit,
-    start=start,
-    format=args.format,
-    full_event=args.full_event)
+    start = datetime.datetime.fromtimestamp(time.time() - args.since).astimezone()
+
+end=None
+if args.end:
+    end = args.end.astimezone()
+elif args.until:
+    end = datetime.datetime.fromtimestamp(time.time() - args.until).astimezone()
+if start and end and end <= start:
+    parser.error('the end time must be after the start time')
+
+try:
+    (coordinate_stream if args.coordinate else dump_stream)(
+        args.stream,
+        profile=args.profile,
+        endpoint_url=args.endpoint_url,
+        follow=args.follow,
+        shard=args.shard,
+        all_shards=args.all_shards,
+        order=args.order,
+        limit=args.limit,
+        start=start,
+        end=end,
+        at_sequence=args.at_sequence,
+        after_sequence=args.after_sequence,
+        format=args.format,
+        output=args.output,
+        compress=args.compress,
+        capacity_fraction=args.capacity_fraction,
+        full_event=args.full_event,
+        fan_out=args.fan_out,
+        decode_processes=args.decode_processes,
+        partition_keys=set(args.partition_keys or []),
+        grep=args.grep and args.grep.encode('utf-8'),
+        where=args.where,
+        select=args.select,
+        checkpoint=args.checkpoint,
+        resume=args.resume,
+        coordinate=args.coordinate,
+        lease_ttl=args.lease_ttl,
+        sample=args.sample,
+        sample_size=args.sample_size,
+        stats=args.stats,
+        progress=args.progress)
+finally:
+    if args.metrics: metrics.write(args.metrics)
@@ -45,12 +45,21 @@ md = Metadata(
     subscribe = 'no',
 )
 
+import argparse
 import base64
+import concurrent.futures
+import datetime
+import gzip
+import http.cookiejar
 import json
 import re
 import requests
+import socket
 import sys
+import threading
+import time
 import urllib.parse
+import uuid
 
 # Run this block to enable logging of HTTP requests and responses.
 if False:
@@ -77,6 +86,178 @@ if False:
 import pprint
 pp = pprint.PrettyPrinter(indent=4, compact=True)
 
+# Responses are printed when running the flow once, but not when generating
+# load.
+verbose = True
+
+def log(o):
+    if verbose: pp.pprint(o)
+
+# All requests share one session so that connections are pooled and reused
+# (the pool is resized for the number of visitors in main()).  Cookies are
+# passed explicitly per visitor, so the session must not keep any of its own.
+session = requests.Session()
+session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+
+class FlowError(Exception):
+    pass
+
+########################################################################
+
+# Latency measurement.  Every request is timed by request(), and the times
+# are collected per step of the flow:
+#
+#   dns       resolving the host name (new connections only)
+#   connect   establishing the TCP connection (new connections only)
+#   ttfb      from sending the request until the response headers arrived,
+#             including connecting (requests' Response.elapsed)
+#   total     until the whole response body was read
+
+class Histogram:
+    """Log-linear histogram of latencies, in the style of HdrHistogram.
+
+    Values (in microseconds) are counted in buckets no wider than 1/64th of
+    their value, so percentiles are accurate to about 1.5% however many
+    values are recorded.  That takes 64 counters per doubling of latency
+    above 128us, so at most about 1400 for latencies under two minutes.
+    """
+
+    bits = 7
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.max = 0
+
+    def record(self, seconds):
+        v = max(0, int(seconds * 1e6))
+        shift = v.bit_length() - self.bits
+        bucket = (v >> shift) << shift if shift > 0 else v
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.max = max(self.max, v)
+
+    def percentile(self, p):
+        """Returns the value (in seconds) that p percent of the values are at or below."""
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(bucket, self.max) / 1e6
+        return self.max / 1e6
+
+    def summary(self):
+        return {
+            'count': self.count,
+            **{ f'p{p}': self.percentile(p) for p in (50, 90, 99) },
+            'max': self.max / 1e6 if self.count else None,
+        }
+
+class StepMetrics:
+    phases = ('dns', 'connect', 'ttfb', 'total')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = { phase: Histogram() for phase in self.phases }
+        self.requests = 0
+        self.errors = {}
+
+    def record(self, times, error=None):
+        with self.lock:
+            self.requests += 1
+            for phase, t in times.items():
+                if t is not None:
+                    self.histograms[phase].record(t)
+            if error is not None:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+metrics = {}
+metrics_lock = threading.Lock()
+
+def step_metrics(step):
+    with metrics_lock:
+        if step not in metrics:
+            metrics[step] = StepMetrics()
+        return metrics[step]
+
+# The DNS and connect times of the connection made by the current thread's
+# request, if it needed a new one.  urllib3 makes connections through
+# urllib3.util.connection.create_connection(); wrap it to resolve the host
+# name and connect separately so that each can be timed.
+connection_times = threading.local()
+
+import urllib3.util.connection
+urllib3_create_connection = urllib3.util.connection.create_connection
+
+def timed_create_connection(address, *args, **kwargs):
+    host, port = address
+    start = time.perf_counter()
+    addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    connection_times.dns = time.perf_counter() - start
+    for i, (_, _, _, _, sockaddr) in enumerate(addresses):
+        start = time.perf_counter()
+        try:
+            sock = urllib3_create_connection(sockaddr[:2], *args, **kwargs)
+        except OSError:
+            if i == len(addresses) - 1:
+                raise
+            continue
+        connection_times.connect = time.perf_counter() - start
+        return sock
+
+urllib3.util.connection.create_connection = timed_create_connection
+
+def request(step, method, url, **kwargs):
+    """Makes a request through the shared session, timing it as part of `step`."""
+    connection_times.__dict__.clear()
+    start = time.perf_counter()
+    try:
+        r = session.request(method, url, **kwargs)
+    except requests.RequestException as e:
+        step_metrics(step).record({ 'total': time.perf_counter() - start }, type(e).__name__)
+        raise
+    step_metrics(step).record({
+        'dns': getattr(connection_times, 'dns', None),
+        'connect': getattr(connection_times, 'connect', None),
+        'ttfb': r.elapsed.total_seconds(),
+        'total': time.perf_counter() - start,
+    }, r.status_code if r.status_code >= 400 else None)
+    return r
+
+def metrics_report(elapsed):
+    return {
+        'elapsed': elapsed,
+        'steps': {
+            step: {
+                'requests': m.requests,
+                'requests_per_second': m.requests / elapsed if elapsed else None,
+                'errors': sum(m.errors.values()),
+                'error_rate': sum(m.errors.values()) / m.requests if m.requests else None,
+                'errors_by_kind': { str(k): n for k, n in m.errors.items() },
+                **{ phase: m.histograms[phase].summary() for phase in StepMetrics.phases },
+            }
+            for step, m in metrics.items()
+        },
+    }
+
+def print_metrics_report(report):
+    def ms(t):
+        return '-' if t is None else f'{t * 1000:.1f}'
+    print(f'{"step":<16} {"reqs":>6} {"req/s":>7} {"err%":>6} '
+          f'{"dns p50":>8} {"conn p50":>8} {"ttfb p50":>8} {"ttfb p99":>8} '
+          f'{"p50":>8} {"p90":>8} {"p99":>8} {"max":>8}   (ms)')
+    for step, m in report['steps'].items():
+        rps = m['requests_per_second']
+        print(f'{step:<16} {m["requests"]:>6} {"-" if rps is None else f"{rps:.1f}":>7} '
+              f'{100 * m["error_rate"]:>6.1f} '
+              f'{ms(m["dns"]["p50"]):>8} {ms(m["connect"]["p50"]):>8} '
+              f'{ms(m["ttfb"]["p50"]):>8} {ms(m["ttfb"]["p99"]):>8} '
+              f'{ms(m["total"]["p50"]):>8} {ms(m["total"]["p90"]):>8} '
+              f'{ms(m["total"]["p99"]):>8} {ms(m["total"]["max"]):>8}')
+
 # Some parameters are converted to JSON, then base64-encoded.
 def encode_base64_json(d):
     return base64.urlsafe_b64encode(json.dumps(d).encode('ascii'))
@@ -85,9 +266,19 @@ def encode_base64_json(d):
 def encode_base64_url_json(d):
     return base64.urlsafe_b64encode(urllib.parse.quote(json.dumps(d)).encode('ascii'))
 
+# The widget doesn't always pad its base64.
+def decode_base64(s):
+    return base64.urlsafe_b64decode(s + '=' * (-len(s) % 4))
+
+def decode_base64_json(s):
+    return json.loads(decode_base64(s))
+
+def decode_base64_url_json(s):
+    return json.loads(urllib.parse.unquote(decode_base64(s).decode('ascii')))
+
 
 # Fetch the profile.
-def get_profile():
+def get_profile(merchant=None):
     b = {
         "c": 8,                     # screen.colorDepth
         "h": 480,                   # window.screen.height
@@ -98,27 +289,26 @@ def get_profile():
         "hc": 6,                    # navigator.hardwareConcurrency
     }
 
-    profile_url = f'https://{host}/events/{merchant_id}/profile'
+    profile_url = f'https://{host}/events/{merchant or merchant_id}/profile'
 
-    r = requests.get(profile_url, params={'b': encode_base64_url_json(b)})
+    r = request('get_profile', 'GET', profile_url, params={'b': encode_base64_url_json(b)})
 
-    pp.pprint(r)
-    print(r.text)
+    log(r)
+    if verbose: print(r.text)
 
     # Parse the profile out of the body.
     match = re.search(r'__setProfile__\(\"([^\"]+)\"', r.text)
     if not match:
-        print(f'unable to parse profile in {r.text}', file=sys.stderr)
-        sys.exit(1)
+        raise FlowError(f'unable to parse profile in {r.text}')
     profile = match.group(1)
 
     # Parse the globalId cookie out of the set-cookie header.
     # set-cookie: globalId=b8a9c0f5-04e2-4f0b-b3aa-7a0a8fa2ecc6; ...
+    global_id = None
     if 'set-cookie' in r.headers:
         match = re.search(r'globalId=([\w\-]+)', r.headers['set-cookie'])
         if not match:
-            print(f'unable to parse profile_id in {r.headers["set-cookie"]}', file=sys.stderr)
-            sys.exit(1)
+            raise FlowError(f'unable to parse profile_id in {r.headers["set-cookie"]}')
         global_id = match.group(1)
 
     return { 'profile': profile, 'global_id': global_id }
@@ -129,14 +319,14 @@ def pub_track_get(type, payload, md, profile):
         'Cookie': f'globalId={profile["global_id"]}',
     }
     metadata = md('widgetDisplayName')
-    r = requests.get(f'https://{host}/track/', headers=headers, params={
+    r = request('pub_track_get', 'GET', f'https://{host}/track/', headers=headers, params={
         **md('merchantId'),
         'metadata': encode_base64_json(metadata),
         'payload': encode_base64_url_json(payload),
         'type': type,
         'tracker': profile['profile'],
     })
-    pp.pprint([ r, r.text ]);
+    log([ r, r.text ]);
     return r.text
 
 # POSTs a track event.
@@ -161,8 +351,8 @@ def pub_track_post(type, payload, profile):
         if kp in payload:
             data[km] = payload[kp]
 
-    r = requests.post(f'https://{host}/events/{merchant_id}/track', headers=headers, data=json.dumps(data))
-    pp.pprint([ r, r.text ])
+    r = request('pub_track_post', 'POST', f'https://{host}/events/{merchant_id}/track', headers=headers, data=json.dumps(data))
+    log([ r, r.text ])
     return r.text
 
 def widget_view(md, profile):
@@ -173,12 +363,12 @@ def get_purl(md, profile):
     headers = {
         'Cookie': f'globalId={profile["global_id"]}',
     }
-    r = requests.get(f'https://{host}/share/referral/short', headers=headers, params={
+    r = request('get_purl', 'GET', f'https://{host}/share/referral/short', headers=headers, params={
         **md('merchantId', 'campaignId', 'widgetConfigId', 'widgetId', 'variantId',
              ('customerEmail', 'email'), ('customerName', 'name'), 'subscribe'),
         'channel': 'purl',
     })
-    pp.pprint([ r, r.text ]);
+    log([ r, r.text ]);
     return r.text
 
 def copy_purl(referral_code, md, profile):
@@ -193,30 +383,401 @@ def copy_purl(referral_code, md, profile):
     return pub_track_post('widget_event', payload, profile)
 
 
-print('\n\nget_profile');
-p = get_profile()
-pp.pprint(p)
+def follow_referral(referral_link):
+    ua_header = {
+        'User-Agent': user_agent,
+    }
+    r = request('referral', 'GET', referral_link, headers=ua_header)
+    log([r, r.text])
+    return r
+
+# Runs the whole flow of a visitor: they get a profile, view the widget, get
+# and copy their personal referral URL (PURL), and follow it.
+def run_flow(md):
+    if verbose: print('\n\nget_profile');
+    p = get_profile()
+    log(p)
+
+    if verbose: print('\n\nwidget_view');
+    r = widget_view(md, p)
+    log(r)
+
+    if verbose: print('\n\nget_purl');
+    r = get_purl(md, p)
+    log(r)
+    rr = json.loads(r)
+    referral_code = rr['data']['code']
+    referral_link = rr['data']['link']
+
+    if verbose: print('\n\ncopy_purl');
+    r = copy_purl(referral_code, md, p)
+    log(r)
+
+    if verbose: print('\n\nfollow referral link');
+    follow_referral(referral_link)
+
+# Each visitor may get their own customer identity so that the requests
+# aren't all for the same customer.
+def random_metadata(md):
+    visitor = uuid.uuid4().hex[:12]
+    return Metadata(md,
+        customerEmail = f'loadtest+{visitor}@example.com',
+        customerName = f'Load Test {visitor}',
+    )
+
+########################################################################
 
-print('\n\nwidget_view');
-r = widget_view(md, p)
-pp.pprint(r)
+# Runs flows for many simulated visitors at once.  A new visitor starts
+# every 1/rate seconds (or as soon as possible when there is no rate), as
+# long as fewer than `concurrency` of them are in progress, until `count`
+# visitors have been started or `duration` seconds have passed.
+def generate_load(concurrency, rate=None, duration=None, count=None, random_identity=False):
+    stats = { 'started': 0, 'succeeded': 0, 'failed': 0, 'errors': {} }
+    lock = threading.Lock()
+    slots = threading.Semaphore(concurrency)
+
+    def visitor():
+        try:
+            run_flow(random_metadata(md) if random_identity else md)
+            with lock:
+                stats['succeeded'] += 1
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'[:200]
+            with lock:
+                stats['failed'] += 1
+                stats['errors'][error] = stats['errors'].get(error, 0) + 1
+        finally:
+            slots.release()
+
+    start = time.monotonic()
+    next_start = start
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        try:
+            while (count is None or stats['started'] < count) and \
+                  (duration is None or time.monotonic() - start < duration):
+                if rate:
+                    time.sleep(max(0, next_start - time.monotonic()))
+                    next_start += 1 / rate
+                slots.acquire()
+                stats['started'] += 1
+                pool.submit(visitor)
+        except KeyboardInterrupt:
+            print('interrupted; waiting for visitors in progress', file=sys.stderr)
+    stats['elapsed'] = time.monotonic() - start
+    return stats
+
+def print_load_summary(stats, unit='flows'):
+    elapsed = stats['elapsed']
+    done = stats['succeeded'] + stats['failed']
+    print(f'{done} {unit} in {elapsed:.1f}s ({done / elapsed:.1f} {unit}/s): '
+          f'{stats["succeeded"]} succeeded, {stats["failed"]} failed')
+    if stats.get('unparsed'):
+        print(f'{stats["unparsed"]} lines could not be parsed')
+    if stats.get('max_lag'):
+        print(f'fell behind schedule by up to {stats["max_lag"]:.1f}s')
+    for error, n in sorted(stats['errors'].items(), key=lambda e: -e[1]):
+        print(f'{n:8} {error}')
+
+########################################################################
+
+# Replay of recorded traffic.  Synthetic visitors all look alike, while
+# real traffic spreads over many merchants, widgets and visitors, which
+# matters to caching and partitioning, so captured requests can be sent
+# again instead.  A capture has one request per line, in the forms
+# parseurl reads:
+#
+#   [TIME] https://public.fbot.me/track/?merchantId=...&metadata=...&payload=...&type=...&tracker=...
+#   [TIME] {"type": "widget_event", "payload": {...}, "merchantId": "...", "tracker": "..."}
+#
+# The first is a GET of /track/; the second the body of a POST to
+# /events/MERCHANT/track, with the tracker from its Authorization header
+# added as "tracker".  TIME, if present, is in seconds since the epoch or
+# in ISO format (without spaces), and lets the requests be sent with the
+# recorded timing.  The host of a URL is replaced with --host.
+
+def parse_time(s):
+    try:
+        return float(s)
+    except ValueError:
+        return datetime.datetime.fromisoformat(s.replace('Z', '+00:00')).timestamp()
+
+def parse_capture(line):
+    """Parses a captured request; returns None for a blank line."""
+    line = line.strip()
+    if not line:
+        return None
+    t = None
+    if not re.match(r'^(?:[a-z]+:/|\{)', line):
+        match = re.match(r'^(\S+)\s+(.*)$', line)
+        if not match:
+            raise ValueError(f'not a URL or a JSON body: {line[:100]}')
+        t = parse_time(match.group(1))
+        line = match.group(2)
+    if re.match(r'^[a-z]+:/', line):
+        url = urllib.parse.urlsplit(line)
+        params = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        return { 'time': t, 'method': 'GET', 'path': url.path, 'fields': params,
+                 'tracker': params.get('tracker') }
+    elif line.startswith('{'):
+        body = json.loads(line)
+        return { 'time': t, 'method': 'POST', 'fields': body, 'tracker': body.pop('tracker', None) }
+    raise ValueError(f'not a URL or a JSON body: {line[:100]}')
+
+def rewrite_capture(capture, sets, merchant=None):
+    """Sets fields of a captured request.
+
+    `sets` are (path, value) pairs, where the path is a parameter of the
+    GET or key of the POST body, or `metadata.KEY` or `payload.KEY` for a
+    key of the (encoded, for a GET) metadata or payload.  `merchant`
+    replaces the merchantId wherever there is one.
+    """
+    fields = capture['fields']
+    get = capture['method'] == 'GET'
+    decoded = {}
+    def field(name):
+        if name not in decoded:
+            if name not in fields:
+                return None
+            if not get:
+                decoded[name] = fields[name]
+            elif name == 'metadata':
+                decoded[name] = decode_base64_json(fields[name])
+            else:
+                decoded[name] = decode_base64_url_json(fields[name])
+        return decoded[name]
+
+    if merchant:
+        for d in (fields, field('metadata'), field('payload')):
+            if isinstance(d, dict) and 'merchantId' in d:
+                d['merchantId'] = merchant
+    for path, value in sets:
+        name, _, key = path.partition('.')
+        if key and name in ('metadata', 'payload'):
+            d = field(name)
+            if isinstance(d, dict):
+                d[key] = value
+        else:
+            fields[path] = value
+
+    if get:
+        if 'metadata' in decoded: fields['metadata'] = encode_base64_json(decoded['metadata'])
+        if 'payload' in decoded: fields['payload'] = encode_base64_url_json(decoded['payload'])
+
+def parse_set(s):
+    """Parses a --set PATH=VALUE; the value is JSON if it can be, otherwise a string."""
+    path, sep, value = s.partition('=')
+    if not sep or not path:
+        raise ValueError('--set is not in format "PATH=VALUE"')
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return (path, value)
+
+# A tracker is a JWT whose payload is
+# ${merchantId}:${profileId}:${globalId}:${attributionId}:${domain}:${epoch}...
+# The globalId cookie that came with it is taken from there.
+def tracker_global_id(tracker):
+    try:
+        return decode_base64(tracker.split('.')[1]).decode('utf-8').split(':')[2] or None
+    except (IndexError, ValueError):
+        return None
+
+# With --new-trackers, each captured tracker is replaced by a profile
+# fetched from --host, so that the events are attributed on the target
+# environment, and the requests of each captured visitor still share one.
+new_trackers = {}
+new_trackers_lock = threading.Lock()
+
+def new_tracker(tracker, merchant):
+    # Requests of the same visitor wait for the first one's profile.
+    with new_trackers_lock:
+        entry = new_trackers.setdefault(tracker, { 'lock': threading.Lock() })
+    with entry['lock']:
+        if 'profile' not in entry:
+            entry['profile'] = get_profile(merchant)
+        return entry['profile']
+
+def replay_request(capture, sets=(), merchant=None, new_trackers=False):
+    rewrite_capture(capture, sets, merchant)
+    fields = capture['fields']
+    tracker = capture['tracker']
+    global_id = tracker_global_id(tracker) if tracker else None
+    if new_trackers:
+        profile = new_tracker(tracker, fields.get('merchantId'))
+        tracker = profile['profile']
+        global_id = profile['global_id']
+    headers = {}
+    if global_id:
+        headers['Cookie'] = f'globalId={global_id}'
+    if capture['method'] == 'GET':
+        if tracker:
+            fields['tracker'] = tracker
+        r = request('replay_get', 'GET', f'https://{host}{capture["path"]}', headers=headers, params=fields)
+    else:
+        if tracker:
+            headers['Authorization'] = tracker
+        r = request('replay_post', 'POST', f'https://{host}/events/{fields.get("merchantId")}/track',
+                    headers=headers, data=json.dumps(fields))
+    if r.status_code >= 400:
+        raise FlowError(f'HTTP {r.status_code} {r.text[:100]}')
+
+def open_capture(path):
+    if path == '-':
+        return sys.stdin
+    elif path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+# Sends the captured requests with up to `concurrency` at once.  With
+# `speed` and recorded times, each request is sent when it was recorded,
+# relative to the first, with the time between them divided by `speed`;
+# otherwise they're sent at `rate` per second or as fast as possible.
+def replay(lines, concurrency, rate=None, speed=None, duration=None, count=None, **opts):
+    stats = { 'started': 0, 'succeeded': 0, 'failed': 0, 'errors': {}, 'unparsed': 0, 'max_lag': 0 }
+    lock = threading.Lock()
+    slots = threading.Semaphore(concurrency)
+
+    def send(capture):
+        try:
+            replay_request(capture, **opts)
+            with lock:
+                stats['succeeded'] += 1
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'[:200]
+            with lock:
+                stats['failed'] += 1
+                stats['errors'][error] = stats['errors'].get(error, 0) + 1
+        finally:
+            slots.release()
+
+    start = time.monotonic()
+    next_start = start
+    first = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        try:
+            for line in lines:
+                if (count is not None and stats['started'] >= count) or \
+                   (duration is not None and time.monotonic() - start >= duration):
+                    break
+                try:
+                    capture = parse_capture(line)
+                except ValueError as e:
+                    if stats['unparsed'] == 0: print(f'cannot parse {line.strip()[:100]!r}: {e}', file=sys.stderr)
+                    stats['unparsed'] += 1
+                    continue
+                if capture is None:
+                    continue
+                due = None
+                if rate:
+                    due = next_start
+                    next_start += 1 / rate
+                elif speed and capture['time'] is not None:
+                    if first is None: first = capture['time']
+                    due = start + (capture['time'] - first) / speed
+                if due is not None:
+                    time.sleep(max(0, due - time.monotonic()))
+                slots.acquire()
+                if due is not None:
+                    stats['max_lag'] = max(stats['max_lag'], time.monotonic() - due)
+                stats['started'] += 1
+                pool.submit(send, capture)
+        except KeyboardInterrupt:
+            print('interrupted; waiting for requests in progress', file=sys.stderr)
+    stats['elapsed'] = time.monotonic() - start
+    return stats
+
+########################################################################
+
+parser = argparse.ArgumentParser(
+    description='Run the public widget flow (profile, widget view, PURL, copy, referral) once, or as a load test, or replay recorded traffic.')
+parser.add_argument(
+    '--host', default=host,
+    help=f'public API host (default {host})')
+parser.add_argument(
+    '-c', '--concurrency', type=int,
+    help='generate load: run the flow for this many visitors at once; with --replay, send this many requests at once (default 10)')
+parser.add_argument(
+    '-r', '--rate', type=float,
+    help='start at most this many visitors (or replayed requests) per second (default as fast as --concurrency allows, or the recorded timing)')
+parser.add_argument(
+    '-d', '--duration', type=float,
+    help='stop starting visitors (or replaying requests) after this many seconds')
+parser.add_argument(
+    '-n', '--count', type=int,
+    help='stop after starting this many visitors (or replaying this many requests)')
+parser.add_argument(
+    '--random-identity', action='store_true',
+    help='give each visitor a random customer email and name')
+parser.add_argument(
+    '--replay', metavar='FILE',
+    help='send the requests captured in FILE (- for stdin, optionally gzipped) instead of running the flow; see the comments above parse_capture()')
+parser.add_argument(
+    '--speed', type=float, default=1,
+    help='with --replay, send the requests this many times faster than recorded; 0 ignores the recorded times (default 1)')
+parser.add_argument(
+    '--set', type=parse_set, action='append', default=[], metavar='PATH=VALUE', dest='sets',
+    help='with --replay, set a parameter of the replayed requests, or a key of their metadata or payload as metadata.KEY or payload.KEY; VALUE is JSON or a string; may be repeated')
+parser.add_argument(
+    '--merchant-id', metavar='ID',
+    help='with --replay, replace the merchantId of the replayed requests with ID')
+parser.add_argument(
+    '--new-trackers', action='store_true',
+    help='with --replay, replace each captured tracker with a profile fetched from --host')
+parser.add_argument(
+    '--json', metavar='FILE',
+    help='also write the latency report as JSON to FILE (- for stdout)')
+args = parser.parse_args()
+if (args.sets or args.merchant_id or args.new_trackers) and not args.replay:
+    parser.error('--set, --merchant-id and --new-trackers require --replay')
+
+host = args.host
+
+def report_metrics(elapsed):
+    report = metrics_report(elapsed)
+    print_metrics_report(report)
+    if args.json == '-':
+        print(json.dumps(report, indent=2))
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if args.replay:
+    concurrency = args.concurrency or 10
+    verbose = False
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=concurrency)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    with open_capture(args.replay) as lines:
+        stats = replay(lines, concurrency, args.rate, args.speed, args.duration, args.count,
+                       sets=args.sets, merchant=args.merchant_id, new_trackers=args.new_trackers)
+    print_load_summary(stats, 'requests')
+    report_metrics(stats['elapsed'])
+    sys.exit(0 if stats['failed'] == 0 else 1)
+
+if not (args.concurrency or args.rate or args.duration or args.count):
+    start = time.monotonic()
+    try:
+        run_flow(random_metadata(md) if args.random_identity else md)
+    except FlowError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        print('\n')
+        report_metrics(time.monotonic() - start)
+    sys.exit(0)
 
-print('\n\nget_purl');
-r = get_purl(md, p)
-pp.pprint(r)
-rr = json.loads(r)
-referral_code = rr['data']['code']
-referral_link = rr['data']['link']
+concurrency = args.concurrency or 1
+if args.duration is None and args.count is None:
+    parser.error('load generation needs --duration or --count')
 
-print('\n\ncopy_purl');
-r = copy_purl(referral_code, md, p)
-pp.pprint(r)
+verbose = False
+adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=concurrency)
+session.mount('https://', adapter)
+session.mount('http://', adapter)
 
-print('\n\nfollow referral link');
-ua_header = {
-    'User-Agent': user_agent,
-}
-r = requests.get(referral_link,headers=ua_header)
-pp.pprint([r, r.text])
+stats = generate_load(concurrency, args.rate, args.duration, args.count, args.random_identity)
+print_load_summary(stats)
+report_metrics(stats['elapsed'])
 
-sys.exit(0)
+sys.exit(0 if stats['failed'] == 0 else 1)